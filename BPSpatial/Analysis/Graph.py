@@ -3,7 +3,10 @@
 """
 import networkx as nx
 import math
-import sympy as sp
+import numpy as np
+import hashlib
+import multiprocessing
+import os
 
 import BPSpatial.Constants as C
 import sys
@@ -199,35 +202,135 @@ class geometry():
         Return
         ------
         xy:         list
-                    coordinate set of the ouput point on the line of the input nodes
+                    coordinate set of the ouput point on the line of the input nodes \n
+                    [] - when the line is oblique and the point is not between the nodes
         """
-        m, b, _ = geometry.lineSpec(node1, node2)
+        xy = geometry.findPointsOnLines([node1], [node2], [distance])[0]
         
-        xy = []
-        if m == True: # parallel to y axis
-            xy.append(node1[0])
-            if node1[1] <= node2[1]:
-                xy.append(node1[1] + distance)
-            else:
-                xy.append(node1[1] - distance)
+        if node1[0] != node2[0] and node1[1] != node2[1]: # oblique line
+            if not (0 <= distance <= geometry.lineLength(node1, node2) + 1e-9):
+                return []
+        return [float(xy[0]), float(xy[1])]
+    
+    @staticmethod
+    def findPointsOnLines(nodes1, nodes2, distances):
+        """
+        Method for finding the points aparting distances from node1 on the 
+        lines of node1 and node2 for many lines at once
         
-        elif m == False: # parallel to x axis
-            if node1[0] <= node2[0]:
-                xy.append(node1[0] + distance)
-            else:
-                xy.append(node1[0] - distance)
-            xy.append(node1[1])
+        Parameters
+        ----------
+        nodes1:     array-like
+                    (x, y) of node1 of each line, shape (n, 2)
         
-        else:
-            x = sp.Symbol('x')
-            z = (x-node1[0])**2 + (m*x+b-node1[1])**2 - distance**2
-            xSolution = sp.solve(z, x)
-            
-            for xSol in xSolution:
-                if (xSol >= node1[0] and xSol <= node2[0]) or (xSol <= node1[0] and xSol >= node2[0]):
-                    xy.append(xSol)
-                    xy.append(xSol*m + b)
-        return xy
+        nodes2:     array-like
+                    (x, y) of node2 of each line, shape (n, 2)
+                
+        distances:  array-like or float
+                    distance from node1 of each line, shape (n,)
+        
+        Return
+        ------
+        xy:         numpy.array
+                    (x, y) of the output points, shape (n, 2) \n
+                    a point beyond node2 is extended along the line \n
+                    when node1 and node2 are the same, the point is taken along the x axis
+        """
+        nodes1 = np.asarray(nodes1, dtype=float).reshape(-1, 2)
+        nodes2 = np.asarray(nodes2, dtype=float).reshape(-1, 2)
+        distances = np.asarray(distances, dtype=float)
+        
+        delta = nodes2 - nodes1
+        length = np.hypot(delta[:, 0], delta[:, 1])
+        
+        unit = np.zeros_like(delta)
+        unit[:, 0] = 1 # direction of the same nodes
+        moving = length > 0
+        unit[moving] = delta[moving] / length[moving, None]
+        # the axis-parallel lines are kept exact
+        unit[moving & (delta[:, 0] == 0), 0] = 0
+        unit[moving & (delta[:, 1] == 0), 1] = 0
+        
+        return nodes1 + unit * distances.reshape(-1, 1)
+                
+
+    @staticmethod
+    def nearestPointsOnSegments(points, segStarts, segEnds, pairPoints=None, pairSegments=None):
+        """
+        Method for finding the nearest point on the candidate segments of each 
+        point for many points at once. A point is projected on a segment and 
+        clamped to the segment, so the nearest point is always on the segment.
+        
+        Parameters
+        ----------
+        points:         array-like
+                        (x, y) of the points, shape (n, 2), or point keys (x, y, ind)
+        
+        segStarts:      array-like
+                        (x, y) of the start vertex of the segments, shape (m, 2)
+                
+        segEnds:        array-like
+                        (x, y) of the end vertex of the segments, shape (m, 2)
+                        
+        pairPoints:     array-like
+                        point index of each (point, candidate segment) pair,
+                        every segment is a candidate of every point if None
+                        
+        pairSegments:   array-like
+                        segment index of each (point, candidate segment) pair
+        
+        Return
+        ------
+        nearXY:         numpy.array
+                        (x, y) of the nearest point of each point, shape (n, 2) \n
+                        nan - when a point has no candidate
+                        
+        distances:      numpy.array
+                        distance to the nearest point, shape (n,) \n
+                        inf - when a point has no candidate
+                        
+        segmentInds:    numpy.array
+                        index of the segment of the nearest point, shape (n,) \n
+                        -1 - when a point has no candidate
+        """
+        # (x, y) of the points, which can be keyed (x, y, ind)
+        points = np.asarray(points, dtype=float).reshape(len(points), -1)[:, :2] if len(points) != 0 else np.zeros((0, 2))
+        segStarts = np.asarray(segStarts, dtype=float).reshape(-1, 2)
+        segEnds = np.asarray(segEnds, dtype=float).reshape(-1, 2)
+        if pairPoints is None:
+            pairPoints = np.repeat(np.arange(len(points)), len(segStarts))
+            pairSegments = np.tile(np.arange(len(segStarts)), len(points))
+        pairPoints = np.asarray(pairPoints, dtype='int64')
+        pairSegments = np.asarray(pairSegments, dtype='int64')
+        
+        nearXY = np.full((len(points), 2), np.nan)
+        distances = np.full(len(points), np.inf)
+        segmentInds = np.full(len(points), -1, dtype='int64')
+        if len(pairPoints) == 0:
+            return nearXY, distances, segmentInds
+        
+        # clamped projection of each pair
+        pnt = points[pairPoints]
+        start = segStarts[pairSegments]
+        end = segEnds[pairSegments]
+        delta = end - start
+        lengthSq = (delta**2).sum(axis=1)
+        t = np.zeros(len(pairPoints))
+        moving = lengthSq > 0
+        t[moving] = ((pnt[moving] - start[moving]) * delta[moving]).sum(axis=1) / lengthSq[moving]
+        t = np.clip(t, 0, 1)
+        proj = start + t[:, None]*delta
+        proj[t == 1] = end[t == 1] # the vertices are kept exact
+        dist = np.hypot(proj[:, 0] - pnt[:, 0], proj[:, 1] - pnt[:, 1])
+        
+        # the nearest pair of each point
+        order = np.lexsort((dist, pairPoints))
+        pointInds, first = np.unique(pairPoints[order], return_index=True)
+        best = order[first]
+        nearXY[pointInds] = proj[best]
+        distances[pointInds] = dist[best]
+        segmentInds[pointInds] = pairSegments[best]
+        return nearXY, distances, segmentInds
                 
 
 class graphCalculate():
@@ -258,6 +361,12 @@ class graphCalculate():
         graph:  networkx graph
                 polyine graph to add the center coordinates of each edge
         """
+        # the segment including the center of each edge is found first,
+        # and the centers of all the edges are computed at once
+        centerEdges = []
+        prevVertices = []
+        currVertices = []
+        distancesToGo = []
         for edge in graph.edges(data=True):
             prevVertex = None
             distnaceToGo = (edge[2]['distance']) / 2
@@ -271,12 +380,20 @@ class graphCalculate():
                     if distnaceToGo > distance:
                         distnaceToGo -= distance
                     else:
-                        centerPoint = geometry.findPointOnLine(prevVertex, currVertex, distnaceToGo)
-                        edge[2]['center'] = [round(centerPoint[0], decimals), round(centerPoint[1], decimals)]
+                        centerEdges.append(edge)
+                        prevVertices.append(prevVertex)
+                        currVertices.append(currVertex)
+                        distancesToGo.append(distnaceToGo)
                         break
                     
                     prevVertex = currVertex
         
+        if centerEdges == []:
+            return
+        centerPoints = geometry.findPointsOnLines(prevVertices, currVertices, distancesToGo)
+        for edge, centerPoint in zip(centerEdges, centerPoints.tolist()):
+            edge[2]['center'] = [round(centerPoint[0], decimals), round(centerPoint[1], decimals)]
+        
     @staticmethod
     def _calculateDistance(graph):
         distanceList = []
@@ -301,7 +418,7 @@ class near():
     """
     
     @staticmethod
-    def pointOnPolyline(polylineGraph, pointGraph, criterion='', threshold=0):
+    def pointOnPolyline(polylineGraph, pointGraph, criterion='', threshold=0, indexPath=None):
         """
         Method for finding the nearest point of individual point feature of 
         a point graph among a set of line features of polyline graph
@@ -314,12 +431,19 @@ class near():
         pointGraph:     networkx graph
                         point graph including points to check
                         
-        criterion:      string
+        criterion:      string or tuple
                         a common column name of point and line features
-                        when finding the nearest point
+                        when finding the nearest point, or a tuple of column names 
+                        for a compound key such as ('Route', 'Direction') \n
+                        each point searches only the lines of its own value
                         
         threshold:      float
-                        searching distance threshold when finding the nearest point
+                        searching distance threshold when finding the nearest point \n
+                        the segments within the threshold are searched if given
+                        
+        indexPath:      string
+                        base path of the segment rtree files of polylineGraph, 
+                        which are reused across runs (see FileIO.RTree.rtree_segments)
                         
         Return
         ------
@@ -328,86 +452,12 @@ class near():
         """
         pntGraph = pointGraph.copy()
         
-        idxLine, edgeIdCoordDict = rtree.rtree_polyline(polylineGraph)
+        points = pntGraph.nodes(data=True)
+        nearXY, distances, _ = spatialjoin._nearestSegments(points, polylineGraph, criterion, threshold, indexPath)
         
-        for pnt in pntGraph.nodes(data=True):
-            nearPolylineId = list(idxLine.nearest(rtree.pointRect(pnt[0]), 3))
-            
-            pointCandidateDict = {}
-            for edgeId in nearPolylineId:
-                edge = edgeIdCoordDict[edgeId] # key of polyline Graph
-                
-                if criterion == '':
-                    
-                    distToStartNode = geometry.lineLength(pnt[0], list(edge[0]))
-                    distToEndNode = geometry.lineLength(pnt[0], list(edge[1]))
-                    if threshold == 0:
-                        pointCandidateDict[distToStartNode] = edge[0]
-                        pointCandidateDict[distToEndNode] = edge[1]
-                    else:
-                        if distToStartNode <= threshold:
-                            pointCandidateDict[distToStartNode] = edge[0]
-                        if distToEndNode <= threshold:
-                            pointCandidateDict[distToEndNode] = edge[1]
-                        
-                    prevVertex = None
-                    for ind, vertex in enumerate(polylineGraph.edge[edge[0]][edge[1]]['coordinates']):
-                        if ind == 0:
-                            prevVertex = vertex
-                        else:
-                            currVertex = vertex
-                            
-                            nearX, nearY = geometry.findNearPointOnLine(prevVertex, currVertex, pnt[0])
-                            nearXY = (nearX, nearY)
-                            
-                            onLine = geometry.isPointOnLine(prevVertex, currVertex, nearXY)
-                            if onLine == True:
-                                distPointLine = geometry.lineLength(nearXY, pnt[0])
-                                if threshold == 0:
-                                    pointCandidateDict[distPointLine] = nearXY
-                                else:
-                                    if distPointLine <= threshold:
-                                        pointCandidateDict[distPointLine] = nearXY
-                            prevVertex = currVertex
-                            
-                else: # if there is a criterion
-                    if polylineGraph.edge[edge[0]][edge[1]][criterion] == pnt[1][criterion]:
-                        
-                        distToStartNode = geometry.lineLength(pnt[0], list(edge[0]))
-                        distToEndNode = geometry.lineLength(pnt[0], list(edge[1]))
-                        if threshold == 0:
-                            pointCandidateDict[distToStartNode] = edge[0]
-                            pointCandidateDict[distToEndNode] = edge[1]
-                        else:
-                            if distToStartNode <= threshold:
-                                pointCandidateDict[distToStartNode] = edge[0]
-                            if distToEndNode <= threshold:
-                                pointCandidateDict[distToEndNode] = edge[1]
-                            
-                        prevVertex = None
-                        for ind, vertex in enumerate(polylineGraph.edge[edge[0]][edge[1]]['coordinates']):
-                            if ind == 0:
-                                prevVertex = vertex
-                            else:
-                                currVertex = vertex
-                                
-                                nearX, nearY = geometry.findNearPointOnLine(prevVertex, currVertex, pnt[0])
-                                nearXY = (nearX, nearY)
-                                
-                                onLine = geometry.isPointOnLine(prevVertex, currVertex, nearXY)
-                                if onLine == True:
-                                    distPointLine = geometry.lineLength(nearXY, pnt[0])
-                                    if threshold == 0:
-                                        pointCandidateDict[distPointLine] = nearXY
-                                    else:
-                                        if distPointLine <= threshold:
-                                            pointCandidateDict[distPointLine] = nearXY
-                                prevVertex = currVertex
-            
-                
-            # after looking through the entire edges, select the edge id with the minimum distance
-            if len(pointCandidateDict) != 0:
-                finalPnt = pointCandidateDict[min(sorted(pointCandidateDict))]
+        for pnt, xy, dist in zip(points, nearXY.tolist(), distances):
+            if dist != np.inf and (threshold == 0 or dist <= threshold):
+                finalPnt = tuple(xy)
                 pntGraph.node[finalPnt] = pntGraph.node.pop(pnt[0])
                 
             else:
@@ -421,72 +471,48 @@ class split():
     Class to implementing split process for polyline graph objects
     """
     @staticmethod
-    def _findPointIter(startNode, endNode, distance):
-        d = geometry.lineLength(startNode, endNode)
-        if d < distance:
-            tempNode = endNode
-            remainD = d
-            iteration = False
-        else:
-            solution = geometry.findPointOnLine(startNode, endNode, distance)
-            
-            tempNode = tuple(solution)
-            remainD = 0
-            iteration = True
-        return tempNode, remainD, iteration
-    
-    @staticmethod
-    def _splitNodes(graph, distance, decimals=6):
-        splitNodesList = []
-        for edge in graph.edges(data=True):
-            
-            # for one edge, find the new edges (sub-edges) and nodes based on the distance 
-            nodeList = [] # node list on a edge list[tuple()]
-            
-            prevVertex = None 
-            currVertex = None
-            remainD = 0      # remaining distance to go
-            distance = distance
-            distanceToGo = distance
+    def _splitPoints(graph, distance, decimals=6):
+        # linear referencing: the chainage of the vertices of each edge is computed once, 
+        # the split points every distance along the edge are located on their segments by the chainage,
+        # and the coordinates of all the points are computed at once
+        # {edge index: [(segment index, split node)]}, split node is None at the end vertex of the segment
+        startNodes = []
+        endNodes = []
+        offsets = []
+        edgeSegInds = [] # (edge index, segment index) of each split point
+        for edgeInd, edge in enumerate(graph.edges(data=True)):
             
-            nodeList.append(edge[0]) # starts with the first node
+            # if the length of the edge is smaller than the distance, the edge is not split
+            if geometry.lineLength(edge[0], edge[1]) < distance:
+                continue
             
-            # if the length of the edge is smaller than the distance, add the end node
-            # without any sub-node
-            edgeLen = geometry.lineLength(edge[0], edge[1])
+            coords = np.asarray(edge[2]['coordinates'], dtype=float).reshape(-1, 2)
+            segLens = np.hypot(*np.diff(coords, axis=0).T)
+            chainage = np.concatenate([[0], np.cumsum(segLens)])
             
-            # if the length of the edge is greater than the distance
-            if edgeLen >= distance:
-                # find the nodes every after the distance
-                for ind, vertex in enumerate(edge[2]['coordinates']):
-                    iteration = True
-                    
-                    if ind == 0:
-                        prevVertex = vertex
-                    else:
-                        currVertex = vertex
-                        
-                        iterationNum = 0
-                        while iteration:
-                            if iterationNum != 0:
-                                distanceToGo = distance
-                            distanceToGo -= remainD
-                            tempPoint, remainD, iteration = split._findPointIter(prevVertex, currVertex, distanceToGo)
-                            if tempPoint != currVertex:
-                                nodeList.append((round(tempPoint[0], decimals), round(tempPoint[1], decimals)))
-                            
-                            iterationNum+=1 
-                            prevVertex = tempPoint
-            
-            nodeList.append(edge[1]) #endNode
-            splitNodesList.extend(nodeList)
-        
-        return list(set(splitNodesList))
+            # a split point at the chainage of a vertex is on the segment ending at the vertex
+            cuts = np.arange(distance, chainage[-1] + 1e-9, distance)
+            segInds = np.clip(np.searchsorted(chainage, cuts) - 1, 0, len(coords) - 2)
+            startNodes.extend(coords[segInds].tolist())
+            endNodes.extend(coords[segInds + 1].tolist())
+            offsets.extend((cuts - chainage[segInds]).tolist())
+            edgeSegInds.extend([(edgeInd, segInd) for segInd in segInds.tolist()])
+        
+        splitDict = {}
+        if offsets != []:
+            splitPoints = geometry.findPointsOnLines(startNodes, endNodes, offsets).tolist()
+            for (edgeInd, segInd), point, endNode in zip(edgeSegInds, splitPoints, endNodes):
+                node = None
+                if tuple(point) != tuple(endNode):
+                    node = (round(point[0], decimals), round(point[1], decimals))
+                splitDict.setdefault(edgeInd, []).append((segInd, node))
+        return splitDict
     
     @staticmethod
     def byDistance(graph, distance, edgeAttrs=[]):
         """
-        Method for spliting polyline object every length of the distance
+        Method for spliting polyline object every length of the distance. 
+        Each edge is cut every distance along the edge from its start node.
         
         Parameters
         ----------
@@ -513,109 +539,43 @@ class split():
         #==============================================================================
         
         splitGraph = nx.DiGraph()
-    
-        nodeList = split._splitNodes(graph, distance)
-        
-        splitGraph.add_nodes_from(nodeList)
         
-        attrsDict = {}
+        splitDict = split._splitPoints(graph, distance)
         
         splitEdgeInd = 0
         for edgeInd, edge in enumerate(graph.edges(data=True)):
-            vertexDict = {}
-            prevVertex = None
-            cumulDistance = 0
-            
-            # for each eage, locate the nodes between the corrseponding vertices
-            for ind, vertex in enumerate(edge[2]['coordinates']):
-                if ind == 0:
-                    prevVertex = vertex
-                    
-                    # add the first vertex in the vertex list
-                    vertexDict[cumulDistance] = prevVertex
-                else:
-                    currVertex = vertex
-                    
-                    
-                    # find the nodes which are between the prevVertex and currVertex
-                    m, b, d = geometry.lineSpec(prevVertex, currVertex)
-                    
-                    for node in nodeList:
-                        if m == True: # parallel to y axis
-                            if node[0] == b and \
-                            (((prevVertex[1] <= node[1]) and (node[1] <= currVertex[1])) or\
-                             ((currVertex[1] <= node[1]) and (node[1] <= prevVertex[1]))):
-                                 # if the node is between the vertices, 
-                                 # calculate the length between the prevVertex and the node
-                                 seglen = geometry.lineLength(prevVertex, node)
-                                 # add the node into the dictionary
-                                 vertexDict[seglen+cumulDistance] = node
-                                
-                        elif m == False:
-                            if node[1] == b and \
-                            (((prevVertex[0] <= node[0]) and (node[0] <= currVertex[0])) or\
-                             ((currVertex[0] <= node[0]) and (node[0] <= prevVertex[0]))):
-                                 # if the node is between the vertices, 
-                                 # calculate the length between the prevVertex and the node
-                                 seglen = geometry.lineLength(prevVertex, node)
-                                 # add the node into the dictionary
-                                 vertexDict[seglen+cumulDistance] = node
-                                 
-                        else:
-                            if(abs(node[1] - (m*node[0] + b)) < 0.05) and \
-                            (((prevVertex[0] <= node[0]) and (node[0] <= currVertex[0])) or\
-                             ((currVertex[0] <= node[0]) and (node[0] <= prevVertex[0]))) and\
-                             (((prevVertex[1] <= node[1]) and (node[1] <= currVertex[1])) or\
-                             ((currVertex[1] <= node[1]) and (node[1] <= prevVertex[1]))):
-                                 # if the node is between the vertices, 
-                                 # calculate the length between the prevVertex and the node
-                                 seglen = geometry.lineLength(prevVertex, node)
-                                 # add the node into the dictionary
-                                 vertexDict[seglen+cumulDistance] = node
-                            
-                    cumulDistance += geometry.lineLength(prevVertex, currVertex)
-                    vertexDict[cumulDistance] = currVertex
-                    
-                    prevVertex = currVertex
+            splitGraph.add_nodes_from([edge[0], edge[1]])
+            coordinates = edge[2]['coordinates']
             
-            
-            orderedVertexList = []
-            for key in sorted(vertexDict.keys()):
-                orderedVertexList.append(list(vertexDict[key]))
-            
-            startInd1 = 0
-            for ind1, vertex1 in enumerate(orderedVertexList):
-                # check whether vertex1 is in nodelist
-                endInd1 = 0
-                for splitNode in nodeList:
-                    if tuple(vertex1) == splitNode:
-                        endInd1 = ind1
-                        
-                        coordList = orderedVertexList[startInd1:endInd1 + 1]
-                        startVertex = tuple(orderedVertexList[startInd1])
-                        endVertex = tuple(orderedVertexList[endInd1])
-                        
-                        if startVertex != endVertex:
-                            splitGraph.add_edge(startVertex, endVertex, Ind=splitEdgeInd, coordinates = coordList)
-                            
-                            attrsDict[(startVertex, endVertex)] = {}
-                            for edgeAttr in edgeAttrs:
-                                attrsDict[(startVertex, endVertex)][edgeAttr] = edge[2][edgeAttr]
-                            
-                            startInd1 = endInd1
-                            splitEdgeInd+=1
-#        print(edgeAttrs)
-#        if edgeAttrs != []:
-#            for attr in edgeAttrs:
-#                print(attr)
-#                attrDict = {key1:val1[attr] for key1, val1 in attrsDict.items()}
-#                print(attrDict)
-#                nx.set_edge_attributes(splitGraph, attr, attrDict)
+            # the pieces of the edge, from a split node to the next one
+            coordList = [list(coordinates[0])]
+            pieceList = []
+            vertexInd = 1 # index of the next vertex to add
+            for segInd, node in splitDict.get(edgeInd, []):
+                coordList.extend([list(vertex) for vertex in coordinates[vertexInd:segInd + 1]])
+                vertexInd = max(vertexInd, segInd + 1)
                 
-        for edge in splitGraph.edges(data=True):
-            for attr in edgeAttrs:
-                edge[2][attr] = attrsDict[(edge[0], edge[1])][attr]
+                # the split point at the end vertex of the segment
+                if node is None:
+                    if segInd + 2 == len(coordinates): # end node of the edge
+                        continue
+                    node = tuple(coordinates[segInd + 1])
+                    vertexInd = segInd + 2
+                    
+                coordList.append(list(node))
+                pieceList.append(coordList)
+                coordList = [list(node)]
+            coordList.extend([list(vertex) for vertex in coordinates[vertexInd:]])
+            pieceList.append(coordList)
             
+            for coordList in pieceList:
+                startVertex = tuple(coordList[0])
+                endVertex = tuple(coordList[-1])
+                if startVertex != endVertex:
+                    splitGraph.add_edge(startVertex, endVertex, Ind=splitEdgeInd, coordinates = coordList)
+                    for edgeAttr in edgeAttrs:
+                        splitGraph.edge[startVertex][endVertex][edgeAttr] = edge[2][edgeAttr]
+                    splitEdgeInd+=1
             
         graphCalculate.addDistance(splitGraph)
         graphCalculate.addCenter(splitGraph)
@@ -873,7 +833,8 @@ class intersect():
     def byGeometry(graph):
         """
         Method for implementing intersect with polyline type graph.
-        The features are recreated based on the geometry (vertices)
+        The features are recreated based on the geometry (vertices), 
+        and keep the attributes of the input features
         
         Parameters
         ----------
@@ -891,65 +852,223 @@ class intersect():
         
         intersectedNodes = intersect._intersections(graph)
         
-        # for each edge, check if any of intersected points are on the edge
+        # each edge is split at its vertices in intersectedNodes in one pass, excluding the two end points
         for edge in graph.edges(data=True):
-            intersectedNodeDict = {}
-            for iNode in intersectedNodes:
-                # excludes the two end points
-                for ind, vertex in enumerate(edge[2]['coordinates'][:-1]):
-                    if ind == 0:
-                        pass
-                    else:
-                        if tuple(vertex) == iNode:
-                            intersectedNodeDict[ind] = vertex
+            coordinates = edge[2]['coordinates']
+            attrs = {key: val for key, val in edge[2].items() if key not in ('Ind', 'coordinates', 'distance', 'center')}
             
-            coordinatesList = []
-            coordinatesList.append(list(edge[0]))
-            for key in sorted(intersectedNodeDict.keys()):
-                coordinatesList.append(intersectedNodeDict[key])
-            coordinatesList.append(list(edge[1]))
+            cutInds = [ind for ind in range(1, len(coordinates) - 1) if tuple(coordinates[ind]) in intersectedNodes]
+            indList = [0] + cutInds + [len(coordinates) - 1]
+            nodeList = [tuple(edge[0])] + [tuple(coordinates[ind]) for ind in cutInds] + [tuple(edge[1])]
             
-            startVertex = None
-            for ind, coord in enumerate(coordinatesList):
-                outputGraph.add_node(tuple(coord))
-                if ind == 0:
-                    startVertex = coord
-                else:
-                    endVertex = coord
-                    startInd = edge[2]['coordinates'].index(startVertex)
-                    endInd = edge[2]['coordinates'].index(endVertex)
-                    
-                    vertexList = None
-                    if edge[2]['coordinates'][startInd:endInd+1] == []:
-                        vertexList = edge[2]['coordinates'][endInd:startInd+1]
-                    else:
-                        vertexList = edge[2]['coordinates'][startInd:endInd+1]
-                    
-                    outputGraph.add_edge(tuple(startVertex), tuple(endVertex),\
-                                         Ind= edgeId, coordinates= vertexList)
-                    startVertex = endVertex
-                    edgeId +=1
+            for ind in range(len(indList) - 1):
+                outputGraph.add_edge(nodeList[ind], nodeList[ind + 1], Ind= edgeId, \
+                                     coordinates= coordinates[indList[ind]:indList[ind + 1] + 1], **attrs)
+                edgeId +=1
         graphCalculate.addDistance(outputGraph)
         return outputGraph
     
 
+# line graph and search options of the worker processes of spatialjoin
+_workerArgs = {}
+
+def _initWorker(lineGraph, criterion, threshold):
+    _workerArgs['lineGraph'] = lineGraph
+    _workerArgs['criterion'] = criterion
+    _workerArgs['threshold'] = threshold
+    
+def _searchBatch(points):
+    _, distances, edgeInds = spatialjoin._nearestSegments(points, _workerArgs['lineGraph'], \
+                                                          _workerArgs['criterion'], _workerArgs['threshold'])
+    return distances, edgeInds, spatialjoin.searchStats
+
+
 class spatialjoin():
     """
     Class to implement spatialjoin analysis between point and line features
     """
+    # counters of the last search of _nearestSegments
+    # points     - number of the points searched
+    # radius     - points searched by the threshold radius
+    # partitions - number of the line partitions by the criterion values
+    # unmatched  - points whose criterion value has no line
+    searchStats = {}
+    
+    # indexes of the lines (or line partitions) of the last search, keyed by the segment digest
+    _indexCache = {}
+    
+    @staticmethod
+    def _criterionValue(attrs, criterion):
+        # criterion is a column name, or a tuple of column names for a compound key
+        if isinstance(criterion, str):
+            return attrs[criterion]
+        return tuple(attrs[col] for col in criterion)
+    
     @staticmethod
-    def _spatialjoin(pntGraph, lineGraph, criterion, threshold):
+    def _partitions(lineGraph, criterion):
+        # line graphs of the edges of each criterion value
+        edgeDict = {}
+        for edge in lineGraph.edges(data=True):
+            edgeDict.setdefault(spatialjoin._criterionValue(edge[2], criterion), []).append(edge)
+        partitionDict = {}
+        for value, edges in edgeDict.items():
+            partitionDict[value] = lineGraph.__class__()
+            partitionDict[value].add_edges_from(edges)
+        return partitionDict
+    
+    @staticmethod
+    def _lineIndex(lineGraph, indexPath, usedCache):
+        segStarts, segEnds, segEdgeInds = rtree.segmentArrays(lineGraph)
+        key = (rtree.segmentDigest(segStarts, segEnds, segEdgeInds), lineGraph.number_of_edges())
+        if key not in spatialjoin._indexCache:
+            idxLine, _ = rtree.rtree_polyline(lineGraph)
+            idxSeg, _, _, _ = rtree.rtree_segments(lineGraph, indexPath)
+            
+            # segments of each edge, which are contiguous
+            edgeInds, segFirsts, segCounts = np.unique(segEdgeInds, return_index=True, return_counts=True)
+            segmentRange = {edgeInd: (first, first + count) for edgeInd, first, count in \
+                            zip(edgeInds.tolist(), segFirsts.tolist(), segCounts.tolist())}
+            spatialjoin._indexCache[key] = (idxLine, idxSeg, segStarts, segEnds, segEdgeInds, segmentRange)
+        usedCache[key] = spatialjoin._indexCache[key]
+        return usedCache[key]
+    
+    @staticmethod
+    def _searchSegments(xyList, lineIndex, threshold):
+        # with a threshold, the segments within the threshold radius are found by 
+        # one box query on the segment rtree, so the nearest segment is exact
+        # without a threshold,
+        # 1) the segments of the 3 nearest edges of each point by the edge rtree,
+        #    and the nearest point on them by one vectorized call
+        # 2) every segment closer than that point is found by a box query on the 
+        #    segment rtree, so the nearest segment is exact among the candidates
+        idxLine, idxSeg, segStarts, segEnds, segEdgeInds, segmentRange = lineIndex
+        
+        if threshold > 0:
+            pairPoints = []
+            pairSegments = []
+            for pntInd, (x, y) in enumerate(xyList):
+                segInds = list(idxSeg.intersection((x-threshold, y-threshold, x+threshold, y+threshold)))
+                pairPoints.extend([pntInd]*len(segInds))
+                pairSegments.extend(segInds)
+                
+        else:
+            pairPoints = []
+            pairSegments = []
+            for pntInd, xy in enumerate(xyList):
+                for edgeId in idxLine.nearest(rtree.pointRect(xy), 3):
+                    first, last = segmentRange.get(edgeId, (0, 0))
+                    pairPoints.extend([pntInd]*(last - first))
+                    pairSegments.extend(range(first, last))
+            _, distances, _ = geometry.nearestPointsOnSegments(xyList, segStarts, segEnds, pairPoints, pairSegments)
+            
+            pairPoints = []
+            pairSegments = []
+            for pntInd, ((x, y), dist) in enumerate(zip(xyList, distances.tolist())):
+                if dist == np.inf:
+                    continue
+                segInds = list(idxSeg.intersection((x-dist, y-dist, x+dist, y+dist)))
+                pairPoints.extend([pntInd]*len(segInds))
+                pairSegments.extend(segInds)
+                
+        nearXY, distances, segmentInds = geometry.nearestPointsOnSegments(xyList, segStarts, segEnds, \
+                                                                           pairPoints, pairSegments)
+        edgeInds = np.full(len(segmentInds), -1, dtype='int64')
+        found = segmentInds != -1
+        edgeInds[found] = segEdgeInds[segmentInds[found]]
+        return nearXY, distances, edgeInds
+    
+    @staticmethod
+    def _nearestSegments(points, lineGraph, criterion, threshold=0, indexPath=None):
+        # with a criterion, the lines are partitioned by the criterion values, 
+        # and each point searches only the partition of its own value
+        usedCache = {}
+        # the point nodes are keyed (x, y) or (x, y, ind) by the loaders of FileIO.Graph
+        xyList = [(point[0][0], point[0][1]) for point in points]
+        stats = {'points': len(points), 'radius': len(points) if threshold > 0 else 0, \
+                 'partitions': 0, 'unmatched': 0}
+        
+        if criterion == '':
+            lineIndex = spatialjoin._lineIndex(lineGraph, indexPath, usedCache)
+            nearXY, distances, edgeInds = spatialjoin._searchSegments(xyList, lineIndex, threshold)
+            
+        else:
+            nearXY = np.full((len(points), 2), np.nan)
+            distances = np.full(len(points), np.inf)
+            edgeInds = np.full(len(points), -1, dtype='int64')
+            
+            pntIndDict = {}
+            for pntInd, point in enumerate(points):
+                pntIndDict.setdefault(spatialjoin._criterionValue(point[1], criterion), []).append(pntInd)
+            partitionDict = spatialjoin._partitions(lineGraph, criterion)
+            stats['partitions'] = len(partitionDict)
+            
+            for value, pntInds in pntIndDict.items():
+                if value not in partitionDict:
+                    stats['unmatched'] += len(pntInds)
+                    continue
+                partPath = None
+                if indexPath is not None:
+                    partPath = '{}_{}'.format(indexPath, hashlib.md5(repr(value).encode()).hexdigest()[:12])
+                lineIndex = spatialjoin._lineIndex(partitionDict[value], partPath, usedCache)
+                partXY, partDistances, partEdgeInds = \
+                    spatialjoin._searchSegments([xyList[ind] for ind in pntInds], lineIndex, threshold)
+                nearXY[pntInds] = partXY
+                distances[pntInds] = partDistances
+                edgeInds[pntInds] = partEdgeInds
+                
+        spatialjoin._indexCache = usedCache
+        spatialjoin.searchStats = stats
+        return nearXY, distances, edgeInds
+    
+    @staticmethod
+    def _buildIndexes(lineGraph, criterion):
+        # in-memory indexes of every line partition, kept in _indexCache
+        usedCache = {}
+        if criterion == '':
+            spatialjoin._lineIndex(lineGraph, None, usedCache)
+        else:
+            for partition in spatialjoin._partitions(lineGraph, criterion).values():
+                spatialjoin._lineIndex(partition, None, usedCache)
+        spatialjoin._indexCache = usedCache
+    
+    @staticmethod
+    def _parallelSegments(points, lineGraph, criterion, threshold, processes, batchSize):
+        # the points are searched in batches across a process pool, and the results 
+        # are concatenated in the batch order, so they are identical to the serial search
+        # the indexes are built once in the current process before the pool starts, 
+        # so the workers share them read-only when forked (built once per worker when spawned)
+        if processes is None:
+            processes = os.cpu_count() or 1
+        if batchSize is None:
+            batchSize = max(int(math.ceil(len(points) / processes)), 1)
+        spatialjoin._buildIndexes(lineGraph, criterion)
+        
+        # only the coordinates and the criterion columns of the points are sent
+        if criterion == '':
+            columns = []
+        else:
+            columns = [criterion] if isinstance(criterion, str) else list(criterion)
+        pointList = [(point[0], {col: point[1][col] for col in columns}) for point in points]
+        batches = [pointList[start:start + batchSize] for start in range(0, len(pointList), batchSize)]
+        
+        with multiprocessing.Pool(min(processes, len(batches)), initializer=_initWorker, \
+                                  initargs=(lineGraph, criterion, threshold)) as pool:
+            results = pool.map(_searchBatch, batches, chunksize=1)
+            
+        stats = {'points': len(points), 'radius': 0, 'partitions': 0, 'unmatched': 0}
+        for _, _, batchStats in results:
+            stats['radius'] += batchStats['radius']
+            stats['unmatched'] += batchStats['unmatched']
+            stats['partitions'] = max(stats['partitions'], batchStats['partitions'])
+        spatialjoin.searchStats = stats
+        return np.concatenate([result[0] for result in results]), np.concatenate([result[1] for result in results])
+    
+    @staticmethod
+    def _spatialjoin(pntGraph, lineGraph, criterion, threshold, indexPath=None, processes=1, batchSize=None):
         
         # init spatialJoinDict showing the edge id matched to each point
         # ind - point id, value - edge id 
         spatialJoinDict = {}
-    
-        pointGraph = pntGraph.copy()
-#        pointGraph = nx.DiGraph()
-        
-#        # create a point graph
-#        for ind, node in enumerate(pntGraph.nodes(data=True)):
-#            pointGraph.add_node(node[0], Ind=node[1]['Ind'])
             
         # init 'matNumDict' showing the number of points matched to each edge
         # ind - edge id, value - 0 (initial)
@@ -957,114 +1076,17 @@ class spatialjoin():
         for edge in lineGraph.edges(data=True):
             matNumDict[edge[2]['Ind']] = 0
             
-        idxLine, edgeIdCoordDict = rtree.rtree_polyline(lineGraph)
+        # match each point to the edge of the nearest segment within the threshold
+        points = pntGraph.nodes(data=True)
+        if processes == 1 or len(points) == 0:
+            _, distances, edgeInds = spatialjoin._nearestSegments(points, lineGraph, criterion, threshold, indexPath)
+        else:
+            distances, edgeInds = spatialjoin._parallelSegments(points, lineGraph, criterion, threshold, \
+                                                                processes, batchSize)
         
-        # match each point to an edge
-        # first iteration - points     
-        for point in pointGraph.nodes(data=True):
-            
-            p = point[0][0]
-            q = point[0][1]
-            
-            nearPolylineId = list(idxLine.nearest(rtree.pointRect(point[0]), 3))
-            
-            # second iteration - edge
-            edgeCandidateDict={}
-            for edgeId in nearPolylineId:
-                edge = edgeIdCoordDict[edgeId]
-                
-                if criterion == '':
-                
-                    # for one point, add the distance to start node and end node to the candidateDict
-                    distToStartNode = geometry.lineLength(point[0], list(edge[0]))
-                    distToEndNode = geometry.lineLength(point[0], list(edge[1]))
-                    
-                    if threshold == 0:
-                        edgeCandidateDict[distToStartNode] = edgeId
-                        edgeCandidateDict[distToEndNode] = edgeId
-                    else:
-                        if distToStartNode <= threshold:
-                            edgeCandidateDict[distToStartNode] = edgeId
-                        
-                        if distToEndNode <= threshold:
-                            edgeCandidateDict[distToEndNode] = edgeId
-                    
-                    prevVertex = None
-                    for ind, vertex in enumerate(lineGraph.edge[edge[0]][edge[1]]['coordinates']):
-                        if ind == 0:
-                            prevVertex = vertex
-                        else:
-                            currVertex = vertex
-                            
-                            a = prevVertex[0]
-                            b = prevVertex[1]
-                            c = currVertex[0]
-                            d = currVertex[1]
-                    
-                            # find the point on the edge which closest from the point p and q
-                            x, y = geometry.findNearPointOnLine((a,b), (c,d), (p,q))
-                    
-                            # chech if the x and y are on the edge
-                            # if true, add it into the dictionary key = distance, value = edge id
-                            onLine = geometry.isPointOnLine(prevVertex, currVertex, [x,y])
-                            if onLine == True:
-                                distPointLine = geometry.lineLength(point[0], [x,y])
-                                if threshold == 0:
-                                    edgeCandidateDict[distPointLine] = edgeId
-                                else:
-                                    if distPointLine <= threshold:
-                                        edgeCandidateDict[distPointLine] = edgeId
-                            
-                            prevVertex = currVertex
-                else: # if there is a criterion
-                    if lineGraph.edge[edge[0]][edge[1]][criterion] == point[1][criterion]:
-                        
-                        # for one point, add the distance to start node and end node to the candidateDict
-                        distToStartNode = geometry.lineLength(point[0], list(edge[0]))
-                        distToEndNode = geometry.lineLength(point[0], list(edge[1]))
-                        
-                        if threshold == 0:
-                            edgeCandidateDict[distToStartNode] = edgeId
-                            edgeCandidateDict[distToEndNode] = edgeId
-                        else:
-                            if distToStartNode <= threshold:
-                                edgeCandidateDict[distToStartNode] = edgeId
-                            
-                            if distToEndNode <= threshold:
-                                edgeCandidateDict[distToEndNode] = edgeId
-                        
-                        prevVertex = None
-                        for ind, vertex in enumerate(lineGraph.edge[edge[0]][edge[1]]['coordinates']):
-                            if ind == 0:
-                                prevVertex = vertex
-                            else:
-                                currVertex = vertex
-                                
-                                a = prevVertex[0]
-                                b = prevVertex[1]
-                                c = currVertex[0]
-                                d = currVertex[1]
-                        
-                                # find the point on the edge which closest from the point p and q
-                                x, y = geometry.findNearPointOnLine((a,b), (c,d), (p,q))
-                        
-                                # chech if the x and y are on the edge
-                                # if true, add it into the dictionary key = distance, value = edge id
-                                onLine = geometry.isPointOnLine(prevVertex, currVertex, [x,y])
-                                if onLine == True:
-                                    distPointLine = geometry.lineLength(point[0], [x,y])
-                                    if threshold == 0:
-                                        edgeCandidateDict[distPointLine] = edgeId
-                                    else:
-                                        if distPointLine <= threshold:
-                                            edgeCandidateDict[distPointLine] = edgeId
-                                
-                                prevVertex = currVertex
-                        
-                
-            # after looking through the entire edges, select the edge id with the minimum distance
-            if len(edgeCandidateDict) != 0:
-                finalEdgeId = edgeCandidateDict[min(sorted(edgeCandidateDict))]
+        for point, dist, edgeInd in zip(points, distances, edgeInds.tolist()):
+            if edgeInd != -1 and (threshold == 0 or dist <= threshold):
+                finalEdgeId = edgeInd
                 spatialJoinDict[point[1]['Ind']] = finalEdgeId
                 matNumDict[finalEdgeId] += 1
             else:
@@ -1075,7 +1097,7 @@ class spatialjoin():
         return matNumDict, spatialJoinDict
         
     @staticmethod
-    def nearest(pntGraph, lineGraph, criterion='', threshold=0):
+    def nearest(pntGraph, lineGraph, criterion='', threshold=0, indexPath=None, processes=1, batchSize=None):
         """
         Method for finding the nearest polyline feature and assign its id to the point feature
         
@@ -1087,21 +1109,40 @@ class spatialjoin():
         lineGraph:  networkx garph
                     polyline type graph whose id's are searched
         
-        criterion:  string
+        criterion:  string or tuple
                     a common column name of point and line features
-                    when finding the nearest point
+                    when finding the nearest point, or a tuple of column names 
+                    for a compound key such as ('Route', 'Direction') \n
+                    each point searches only the lines of its own value
             
         threshold:  float
-                    searching radius
+                    searching radius \n
+                    the segments within the radius are searched if given 
+                    (see spatialjoin.searchStats)
+                    
+        indexPath:  string
+                    base path of the segment rtree files of lineGraph, 
+                    which are reused across runs (see FileIO.RTree.rtree_segments)
+                    
+        processes:  int
+                    number of worker processes, os.cpu_count() if None \n
+                    1 - searches the points in the current process \n
+                    the workers use in-memory indexes, and indexPath is not used \n
+                    on Windows, call it under if __name__ == "__main__":
+                    
+        batchSize:  int
+                    number of points sent to a worker at once, 
+                    the points divided evenly among the workers if None
                     
         """
-        _, spatialJoinDict = spatialjoin._spatialjoin(pntGraph, lineGraph, criterion, threshold)
+        _, spatialJoinDict = spatialjoin._spatialjoin(pntGraph, lineGraph, criterion, threshold, indexPath, \
+                                                      processes, batchSize)
         for point in pntGraph.nodes(data=True):
             point[1]['nearEdge'] = spatialJoinDict[point[1]['Ind']]
         print('The Ind of the nearest polyline is added to the POINT type graph.')
         
     @staticmethod
-    def joincount(pntGraph, lineGraph, criterion='', threshold=0):
+    def joincount(pntGraph, lineGraph, criterion='', threshold=0, indexPath=None, processes=1, batchSize=None):
         """
         Method for calculating the number of points which assigned to each polyline object in the spatial join process        
         Parameters
@@ -1112,15 +1153,34 @@ class spatialjoin():
         lineGraph:  networkx garph
                     polyline type graph whose id's are searched
         
-        criterion:  string
+        criterion:  string or tuple
                     a common column name of point and line features
-                    when finding the nearest point
+                    when finding the nearest point, or a tuple of column names 
+                    for a compound key such as ('Route', 'Direction') \n
+                    each point searches only the lines of its own value
             
         threshold:  float
-                    searching radius
+                    searching radius \n
+                    the segments within the radius are searched if given 
+                    (see spatialjoin.searchStats)
+                    
+        indexPath:  string
+                    base path of the segment rtree files of lineGraph, 
+                    which are reused across runs (see FileIO.RTree.rtree_segments)
+                    
+        processes:  int
+                    number of worker processes, os.cpu_count() if None \n
+                    1 - searches the points in the current process \n
+                    the workers use in-memory indexes, and indexPath is not used \n
+                    on Windows, call it under if __name__ == "__main__":
+                    
+        batchSize:  int
+                    number of points sent to a worker at once, 
+                    the points divided evenly among the workers if None
                     
         """
-        matNumDict, _ = spatialjoin._spatialjoin(pntGraph, lineGraph, criterion, threshold)
+        matNumDict, _ = spatialjoin._spatialjoin(pntGraph, lineGraph, criterion, threshold, indexPath, \
+                                                 processes, batchSize)
         for edge in lineGraph.edges(data=True):
             edge[2]['joinCount'] = matNumDict[edge[2]['Ind']]
         print('The join count is added to the POLYLINE type graph.')
@@ -316,6 +316,21 @@ def pointGraph_to_xlsx(pointGraph, filepath, sheetname):
     finally:
         write_row(filepath, sheetname, dataList)
         
+def _nestedDict_to_rows(nestedDict):
+    """
+    Generator of the rows [key, val1, val2, ...] of a nested dictionary. 
+    A value of other types than str, float, int and bool is converted to str.
+    """
+    survivedType = ["<class 'str'>", "<class 'float'>" , "<class 'int'>", "<class 'bool'>"]
+    for key1, val1 in nestedDict.items():
+        rowList = [key1]
+        for key2, val2 in val1.items():
+            if str(type(val2)) in survivedType: # only acceptable type takes its own type
+                rowList.append(val2)
+            else: # otherwise, it takes str type
+                rowList.append(str(val2))
+        yield rowList
+
 def nestedDict_to_xlsx(nestedDict, filepath, sheetname, colNames=[]):
     """
     Method for converting nested dictionary to excel file
@@ -334,7 +349,6 @@ def nestedDict_to_xlsx(nestedDict, filepath, sheetname, colNames=[]):
     colNames:   list of string
                 a list of column names. The number of column names should be same to that of data variables
     """
-    survivedType = ["<class 'str'>", "<class 'float'>" , "<class 'int'>", "<class 'bool'>"]
     if colNames == []:
         columns = [str(key) for key in nestedDict.values()[0].keys()]
         columns.insert(0, 'key')
@@ -342,14 +356,7 @@ def nestedDict_to_xlsx(nestedDict, filepath, sheetname, colNames=[]):
         assert(len(colNames) == len(list(nestedDict.values())[0].keys()) + 1 )
         
     dataList = [colNames]
-    for key1, val1 in nestedDict.items():
-        rowList = [key1]
-        for key2, val2 in val1.items():
-            if str(type(val2)) in survivedType: # only acceptable type takes its own type
-                rowList.append(val2)
-            else: # otherwise, it takes str type
-                rowList.append(str(val2))
-        dataList.append(rowList)
+    dataList.extend(_nestedDict_to_rows(nestedDict))
         
     try:
         clear_sheet(filepath, sheetname)
@@ -360,4 +367,38 @@ def nestedDict_to_xlsx(nestedDict, filepath, sheetname, colNames=[]):
     
         
     
-        
\ No newline at end of file
+
+def nestedDicts_to_xlsx(nestedDicts, filepath, sheetname, colNames):
+    """
+    Method for writing nested dictionaries one after another to a new excel file. 
+    The rows are streamed, so only one dictionary is held in memory at a time.
+    
+    Parameters
+    ----------
+    nestedDicts:    iterable of nested dictionaries
+                    e.g. a generator of the dictionary of each month
+                    
+    filepath:   string
+                path of the excel file to create            
+    
+    sheetname:  string
+                name of sheet to create
+                
+    colNames:   list of string
+                a list of column names, including the key. 
+                The number of column names should be same to that of data variables of the first row,
+                and a shorter row (e.g. an accident without a point) is padded with empty cells
+    """
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet(sheetname)
+    ws.append(colNames)
+    isFirst = True
+    for nestedDict in nestedDicts:
+        for rowList in _nestedDict_to_rows(nestedDict):
+            if isFirst:
+                assert(len(colNames) == len(rowList))
+                isFirst = False
+            rowList.extend([None] * (len(colNames) - len(rowList)))
+            ws.append(rowList)
+    wb.save(filepath)
+    
@@ -2,32 +2,135 @@
 @author: bspark
 """
 import numpy as np
+import hashlib
+import os
 from rtree import index
 
 def pointRect(coord):
         return (coord[0]-1, coord[1]-1, coord[0]+1, coord[1]+1)
 
 def lineRect(lineGraph, node1, node2):
-    left = min(np.array(lineGraph.edge[node1][node2]['coordinates'])[:,0])
-    bottom = min(np.array(lineGraph.edge[node1][node2]['coordinates'])[:,1])
-    right = max(np.array(lineGraph.edge[node1][node2]['coordinates'])[:,0])
-    up = max(np.array(lineGraph.edge[node1][node2]['coordinates'])[:,1])
+    coords = np.array(lineGraph.edge[node1][node2]['coordinates'])
+    left = min(coords[:,0])
+    bottom = min(coords[:,1])
+    right = max(coords[:,0])
+    up = max(coords[:,1])
     return (left, bottom, right, up)
     
 
 def rtree_polyline(polylineGraph):
-    idxLine = index.Index()
     edgeIdCoordDict = {}
+    entryList = []
     for edge in polylineGraph.edges(data=True):
-#            left = min(np.array(edge[2]['coordinates'])[:,0])
-#            bottom = min(np.array(edge[2]['coordinates'])[:,1])
-#            right = max(np.array(edge[2]['coordinates'])[:,0])
-#            up = max(np.array(edge[2]['coordinates'])[:,1])
-#            idxLine.insert(int(edge[2]['Ind']), (left, bottom, right, up))
-        
         lineRectVal = lineRect(polylineGraph, edge[0], edge[1])
-        idxLine.insert(int(edge[2]['Ind']), lineRectVal)
+        entryList.append((int(edge[2]['Ind']), lineRectVal, None))
         
         edgeIdCoordDict[edge[2]['Ind']] = (edge[0], edge[1])
-        
+    
+    # the edges are bulk-loaded (stream loading), which needs one entry at least
+    idxLine = index.Index(iter(entryList)) if entryList != [] else index.Index()
     return idxLine, edgeIdCoordDict
+
+
+def segmentArrays(polylineGraph):
+    """
+    Method for getting the vertex-to-vertex segments of the edges of a polyline graph as flat arrays
+    
+    Parameters
+    ----------
+    polylineGraph:  networkx graph
+                    polyline graph with 'Ind' and 'coordinates' of each edge
+                    
+    Return
+    ------
+    segStarts:      numpy.array
+                    (x, y) of the start vertex of each segment, shape (m, 2)
+                    
+    segEnds:        numpy.array
+                    (x, y) of the end vertex of each segment, shape (m, 2)
+                    
+    segEdgeInds:    numpy.array
+                    Ind of the edge of each segment, the segments of an edge are contiguous
+    """
+    startList = []
+    endList = []
+    edgeIndList = []
+    for edge in polylineGraph.edges(data=True):
+        coords = np.asarray(edge[2]['coordinates'], dtype=float).reshape(-1, 2)
+        startList.append(coords[:-1])
+        endList.append(coords[1:])
+        edgeIndList.append(np.full(max(len(coords) - 1, 0), edge[2]['Ind'], dtype='int64'))
+    if startList == []:
+        return np.zeros((0, 2)), np.zeros((0, 2)), np.zeros(0, dtype='int64')
+    return np.concatenate(startList), np.concatenate(endList), np.concatenate(edgeIndList)
+
+
+def segmentDigest(segStarts, segEnds, segEdgeInds):
+    """
+    Method for getting the sha1 digest of the segment arrays of segmentArrays, 
+    which identifies the segments of a polyline graph across graph objects and runs
+    """
+    sha1 = hashlib.sha1()
+    for arr in (segStarts, segEnds, segEdgeInds):
+        sha1.update(np.ascontiguousarray(arr).tobytes())
+    return sha1.hexdigest()
+
+
+def rtree_segments(polylineGraph, path=None):
+    """
+    Method for building an rtree with one entry per segment of the edges of 
+    a polyline graph. The entries are bulk-loaded (stream loading), and the id
+    of an entry is the position of its segment in the arrays of segmentArrays.
+    
+    Parameters
+    ----------
+    polylineGraph:  networkx graph
+                    polyline graph with 'Ind' and 'coordinates' of each edge
+                    
+    path:           string
+                    base path of the index files (path.idx, path.dat, path.npz) \n
+                    the index is reused when it is built from the same segments, 
+                    and built in memory if None
+                    
+    Return
+    ------
+    idxSeg:         rtree index
+                    index of the segments
+                    
+    segStarts:      numpy.array
+                    (x, y) of the start vertex of each segment
+                    
+    segEnds:        numpy.array
+                    (x, y) of the end vertex of each segment
+                    
+    segEdgeInds:    numpy.array
+                    Ind of the edge of each segment
+    """
+    segStarts, segEnds, segEdgeInds = segmentArrays(polylineGraph)
+    
+    if path is not None:
+        digest = segmentDigest(segStarts, segEnds, segEdgeInds)
+        
+        # the npz file is written last, so an index with the npz file is complete
+        if os.path.exists(path + '.npz') and os.path.exists(path + '.idx'):
+            with np.load(path + '.npz') as saved:
+                if str(saved['digest']) == digest:
+                    return index.Index(path), segStarts, segEnds, segEdgeInds
+        for suffix in ('.npz', '.idx', '.dat'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+    
+    lower = np.minimum(segStarts, segEnds)
+    upper = np.maximum(segStarts, segEnds)
+    rects = np.column_stack([lower, upper]).tolist()
+    stream = ((ind, tuple(rect), None) for ind, rect in enumerate(rects))
+    
+    if len(rects) == 0: # stream loading needs one entry at least
+        idxSeg = index.Index(path) if path is not None else index.Index()
+    elif path is None:
+        idxSeg = index.Index(stream)
+    else:
+        idxSeg = index.Index(path, stream)
+        idxSeg.flush()
+        np.savez(path + '.npz', digest=digest)
+    return idxSeg, segStarts, segEnds, segEdgeInds
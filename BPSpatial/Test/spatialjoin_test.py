@@ -0,0 +1,86 @@
+import BPSpatial.Constants as C
+
+import sys
+sys.path.append(C.HOME)
+sys.path.append(C.BPSPATIAL)
+
+import FileIO.Graph as GIO
+import Analysis.Graph as AG
+
+# =============================================================================
+# Regression check of spatialjoin and near with the point graphs of FileIO.Graph,
+# whose nodes are keyed (x, y, ind). The nearest edge of each point is compared
+# with a brute-force search over every segment of the polyline graph.
+# =============================================================================
+pointShpPath = '{}testPoint2_UTM11N.shp'.format(C.TEST)
+polylineShpPath = '{}testNetwork2_UTM11N.shp'.format(C.TEST)
+
+def polylineDistance(xy, coords):
+    # distance from a point to the nearest segment of a polyline
+    x, y = xy[0], xy[1]
+    minDist = None
+    for (x1, y1), (x2, y2) in zip(coords[:-1], coords[1:]):
+        dx, dy = x2 - x1, y2 - y1
+        t = 0 if dx == dy == 0 else ((x - x1)*dx + (y - y1)*dy) / (dx*dx + dy*dy)
+        t = min(max(t, 0), 1)
+        dist = ((x1 + t*dx - x)**2 + (y1 + t*dy - y)**2)**(1/2)
+        if minDist is None or dist < minDist:
+            minDist = dist
+    return minDist
+
+def bruteForce(pointGraph, polylineGraph, criterion, threshold):
+    # {point Ind: distance to the nearest edge}, None if no edge is within the threshold
+    nearDict = {}
+    for point in pointGraph.nodes(data=True):
+        dists = [polylineDistance(point[0], edge[2]['coordinates']) for edge in polylineGraph.edges(data=True) \
+                 if criterion == '' or edge[2][criterion] == point[1][criterion]]
+        dists = [dist for dist in dists if dist is not None]
+        if dists != [] and (threshold == 0 or min(dists) <= threshold):
+            nearDict[point[1]['Ind']] = min(dists)
+        else:
+            nearDict[point[1]['Ind']] = None
+    return nearDict
+
+def checkJoin(pointGraph, polylineGraph, criterion, threshold, processes=1):
+    nearDict = bruteForce(pointGraph, polylineGraph, criterion, threshold)
+    matched = sum(1 for dist in nearDict.values() if dist is not None)
+    coordDict = {edge[2]['Ind']: edge[2]['coordinates'] for edge in polylineGraph.edges(data=True)}
+    
+    AG.spatialjoin.nearest(pointGraph, polylineGraph, criterion, threshold, processes=processes)
+    for point in pointGraph.nodes(data=True):
+        nearEdge = point[1]['nearEdge']
+        if nearDict[point[1]['Ind']] is None:
+            assert(nearEdge == -1), (point, nearEdge)
+        else:
+            # the joined edge is at the brute-force distance (a tie can join another edge)
+            dist = polylineDistance(point[0], coordDict[nearEdge])
+            assert(abs(dist - nearDict[point[1]['Ind']]) < 1e-6), (point, nearEdge)
+    
+    AG.spatialjoin.joincount(pointGraph, polylineGraph, criterion, threshold, processes=processes)
+    assert(sum(edge[2]['joinCount'] for edge in polylineGraph.edges(data=True)) == matched)
+    
+    nearGraph = AG.near.pointOnPolyline(polylineGraph, pointGraph, criterion, threshold)
+    xyDict = {point[1]['Ind']: point[0] for point in pointGraph.nodes(data=True)}
+    for point in nearGraph.nodes(data=True):
+        xy = xyDict[point[1]['Ind']]
+        dist = ((point[0][0] - xy[0])**2 + (point[0][1] - xy[1])**2)**(1/2)
+        assert(abs(dist - nearDict[point[1]['Ind']]) < 1e-6), point
+    # the points of the same nearest point share a node
+    assert(nearGraph.number_of_nodes() <= matched)
+    print('criterion: {}, threshold: {}, processes: {}, matched: {} - OK'.format(\
+          repr(criterion), threshold, processes, matched))
+
+if __name__ == "__main__":
+    pointGraph = GIO.Point.fromShapefile(pointShpPath, ['Id'])
+    polylineGraph = GIO.Polyline.fromShapefile(polylineShpPath, ['Id'])
+    assert(all(len(point) == 3 for point in pointGraph.nodes())) # keyed (x, y, ind)
+
+    # a common attribute of the points and the edges for the criterion
+    for point in pointGraph.nodes(data=True):
+        point[1]['side'] = point[1]['Ind'] % 2
+    for edge in polylineGraph.edges(data=True):
+        edge[2]['side'] = edge[2]['Ind'] % 2
+
+    for criterion, threshold in [('', 0), ('', 200), ('side', 0), ('side', 200)]:
+        checkJoin(pointGraph, polylineGraph, criterion, threshold)
+    checkJoin(pointGraph, polylineGraph, 'side', 0, processes=2)
@@ -11,12 +11,15 @@ DIR_COLNAME = 'chp_incidents_month_column_names.xlsx'
 SHEET_RECORD = 'CHP Incidents Month'
 SHEET_DETAIL = 'CHP Incidents Month Detail'
 
+CACHE = ROOT + 'cache\\'
+
 ADMIN = ROOT+'data\\Admin_boundary\\'
 STATE = 'tl_2017_us_state_CA\\tl_2017_us_state_CA.shp'
 COUNTY = 'tl_2017_us_county_CA\\tl_2017_us_county_CA.shp'
 DISTRICT = 'District_2016\\District_2016.shp'
 
 INCIDENTS = ROOT+'data\\Incidents\\'
+MANIFEST = INCIDENTS + 'HOV_Accidents_manifest.json' # fingerprints of the processed raw files
 
 HIGHWAYS = ROOT+'data\\Highways\\'
 
@@ -35,6 +38,26 @@ TYPES_SHP = {'str': 'C', 'float': 'N', 'int': 'N', 'boolean':'L', 'set': 'C', \
 
 TYPES_EXCEL = {'int64': 'int', 'float64':'float', 'object':'str', 'bool':'bool'}
 
+TYPES_CSV = {'int': 'Int64', 'float': 'float64', 'str': 'str'} # nullable integer for missing values
+RAW_COMPRESSIONS = ['.gz', '.bz2', '.zst', '.zip'] # compressed raw files, read when the .txt file does not exist
+CSV_READER = 'pyarrow' # reader of the raw files, 'pyarrow' (multithreaded, if installed) or 'pandas'
+
+# record columns with few distinct values, kept as categoricals
+# CC Code, Description, Location, Area, Direction
+CATEGORY_COLUMNS = [1, 4, 5, 6, 15]
+
+# classification rules of the incidents, evaluated to boolean record columns (see Incidents.RuleSet)
+# a record is flagged if any condition holds and none of the excluded flags holds
+# condition: (kind, column, values)
+#   kind   - 'prefix' (code prefix), 'keyword' (substring, case-insensitive) or 'pattern' (regular expression, case-insensitive)
+#   column - record column index, or 'detail' for the detail messages of the incident
+RULES = [{'name': 'hov', 'column': 21, \
+          'any': [('keyword', 5, ['hov']), ('keyword', 'detail', ['hov'])]}, \
+         {'name': 'accident', 'column': 22, \
+          'any': [('prefix', 4, ['1179', '1180', '1181', '1182', '1183', '2000'])]}, \
+         {'name': 'hazard', 'column': 23, \
+          'any': [('prefix', 4, ['1125'])], 'exclude': ['accident']}]
+
 
 CRS_PRJ = [3311, 'epsg']
 # NAD83(HARN) / California Albers
@@ -1,8 +1,26 @@
 import pandas as pd
-import copy
-import math
+import numpy as np
 import sys
+import os
+import json
+import re
+import hashlib
 import datetime, pytz, time
+import multiprocessing
+import io, gzip, bz2, zipfile
+import threading, queue
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    import pyarrow.csv as pacsv
+except ImportError: # the parquet cache and the multithreaded reader are not available
+    pa = None
+    
+try:
+    import zstandard as zstd
+except ImportError: # .zst raw files are not readable
+    zstd = None
 
 import HOV_Incidents_new.Constants as C
 sys.path.append(C.HOME)
@@ -57,6 +75,49 @@ def nestedDictToList(nestedDict):
     return outputList
 
 
+def frameToNestedDict(frame):
+    """
+    Method that converts a dataframe to a double dictionary
+    
+    Parameters
+    ----------
+    
+    frame          : Pandas.Dataframe
+                     in this project,
+                     a dataframe of incidents (index - incident Id, columns - column index)
+                     
+    Return
+    ------
+    nestedDict     : dictionary
+                     a nested dictionary {Incident Id : {column Name : value}}
+    """
+    # the values are taken by column with tolist, which gives python scalars 
+    # (e.g. int, not numpy.int64 of the nullable integer columns)
+    columns = list(frame.columns)
+    rows = zip(*[frame[col].tolist() for col in columns]) if columns != [] else [()] * len(frame)
+    return {key: dict(zip(columns, row)) for key, row in zip(frame.index.tolist(), rows)}
+
+
+def concatCategories(frames):
+    """
+    Method that concatenates dataframes, keeping the categorical columns 
+    categorical over the union of their categories
+    """
+    frames = list(frames)
+    if frames == []:
+        return pd.DataFrame()
+    frames = [frame.copy(deep=False) for frame in frames]
+    for col in frames[0].columns:
+        if not isinstance(frames[0][col].dtype, pd.CategoricalDtype):
+            continue
+        categories = pd.Index([], dtype=object)
+        for frame in frames:
+            categories = categories.append(frame[col].cat.categories).unique()
+        for frame in frames:
+            frame[col] = frame[col].cat.set_categories(categories)
+    return pd.concat(frames)
+
+
 def getUnixTime(timeList):
     """
     Method that gets unix time in PST from a form of list
@@ -77,10 +138,622 @@ def getUnixTime(timeList):
     return int(utcUnix - gap)
     
 
+def splitTimeArray(timestamps):
+    """
+    Method that converts a column of timestamps (MM/DD/YYYY HH24:MI:SS) 
+    to arrays of year, month, day, hour and unix time at once.
+    The unix time is identical to the one of getUnixTime.
+    Invalid timestamps are marked as -1 in every array.
+    
+    Parameters
+    ----------
+    
+    timestamps     : array-like
+                     timestamps of incidents (e.g. column 3 of the records)
+                     
+    Return
+    ------
+    timeDict       : dictionary
+                     {'year', 'month', 'day', 'hour', 'unixTime' : numpy.array(int64)}
+    """
+    timestamps = pd.Series(np.asarray(timestamps, dtype=object)).astype(str)
+    wallTime = pd.to_datetime(timestamps, format='%m/%d/%Y %H:%M:%S', errors='coerce')
+    invalid = wallTime.isna().values
+    
+    # offset of US/Pacific from UTC in seconds (28800 or 25200)
+    # ambiguous and non-existent local times take the standard time as pytz.localize does
+    pacificTime = wallTime.dt.tz_localize('US/Pacific', ambiguous=np.zeros(len(wallTime), dtype=bool), \
+                                          nonexistent='NaT')
+    gap = (pacificTime.dt.tz_convert('UTC').dt.tz_localize(None) - wallTime).dt.total_seconds()
+    gap = gap.fillna(8*3600).values.astype('int64')
+    
+    # time.mktime of getUnixTime reads the wall time as the local standard time
+    wallSeconds = (wallTime - pd.Timestamp(1970, 1, 1)).dt.total_seconds().fillna(-1).values.astype('int64')
+    unixTime = wallSeconds + time.timezone - gap
+    
+    timeDict = {'year': wallTime.dt.year, 'month': wallTime.dt.month, 'day': wallTime.dt.day, \
+                'hour': wallTime.dt.hour}
+    for key, val in timeDict.items():
+        timeDict[key] = val.fillna(-1).values.astype('int64')
+    unixTime[invalid] = -1
+    timeDict['unixTime'] = unixTime
+    return timeDict
+    
+
+class PrefetchReader(io.RawIOBase):
+    """
+    Binary stream which reads another stream ahead in a background thread, 
+    so that the decompression of a raw file overlaps with its parsing.
+    
+    Parameters
+    ----------
+    
+    stream:             file object
+                        binary stream to read, e.g. gzip.open(path)
+                        
+    name:               str
+                        name of the stream (the path of the file)
+                        
+    blockSize:          int
+                        number of bytes per block
+                        
+    depth:              int
+                        number of blocks read ahead
+    """
+    def __init__(self, stream, name=None, blockSize=1 << 20, depth=8):
+        self.name = name
+        self._queue = queue.Queue(maxsize=depth)
+        self._stop = threading.Event()
+        self._block = memoryview(b'')
+        self._done = False
+        self._thread = threading.Thread(target=self._prefetch, args=(stream, blockSize), daemon=True)
+        self._thread.start()
+        
+    def _prefetch(self, stream, blockSize):
+        try:
+            with stream:
+                while not self._stop.is_set():
+                    block = stream.read(blockSize)
+                    self._put(block)
+                    if block == b'': # end of the stream
+                        return
+        except Exception as e: # raised again in the reading thread
+            self._put(e)
+            
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+    
+    def readable(self):
+        return True
+    
+    def readinto(self, buffer):
+        while len(self._block) == 0 and not self._done:
+            item = self._queue.get()
+            if isinstance(item, Exception):
+                raise item
+            self._done = item == b''
+            self._block = memoryview(item)
+        size = min(len(buffer), len(self._block))
+        buffer[:size] = self._block[:size]
+        self._block = self._block[size:]
+        return size
+    
+    def close(self):
+        self._stop.set()
+        io.RawIOBase.close(self)
+        
+        
+def resolveRawPath(path):
+    """
+    Method that gets the path of a raw file, or of its compressed copy 
+    (C.RAW_COMPRESSIONS) if the text file does not exist
+    
+    Parameters
+    ----------
+    
+    path           : str
+                     path of the text file, e.g. ..._2014_11.txt
+                     
+    Return
+    ------
+    path           : str
+                     e.g. ..._2014_11.txt.gz or ..._2014_11.zip
+    """
+    if os.path.exists(path):
+        return path
+    for suffix in C.RAW_COMPRESSIONS:
+        for candidate in [path + suffix, os.path.splitext(path)[0] + suffix]:
+            if os.path.exists(candidate):
+                return candidate
+    return path # reported as missing when the file is read
+
+
+def openRawFile(path, blockSize=1 << 20):
+    """
+    Method that opens a raw file for pd.read_csv or readCsvArrow. 
+    A compressed file (.gz, .bz2, .zst, or .zip with a single text file) is 
+    streamed through a PrefetchReader without extracting it to the disk.
+    
+    Parameters
+    ----------
+    
+    path           : str
+                     path of the file
+                     
+    blockSize      : int
+                     number of bytes decompressed per block
+                     
+    Return
+    ------
+    file           : str or file object
+                     the path itself if the file is not compressed
+    """
+    suffix = os.path.splitext(path)[1].lower()
+    if suffix == '.gz':
+        stream = gzip.open(path, 'rb')
+    elif suffix == '.bz2':
+        stream = bz2.open(path, 'rb')
+    elif suffix == '.zst':
+        if zstd is None:
+            raise ImportError('zstandard is required to read {}'.format(path))
+        stream = zstd.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+    elif suffix == '.zip':
+        archive = zipfile.ZipFile(path)
+        members = [info for info in archive.infolist() if not info.is_dir()]
+        if len(members) != 1:
+            raise ValueError('{} has {} files, but a single text file is expected'.format(path, len(members)))
+        stream = archive.open(members[0])
+    else:
+        return path
+    return io.BufferedReader(PrefetchReader(stream, path, blockSize), buffer_size=blockSize)
+
+
+def readCsvArrow(path, dtypes, skipInvalid=False, chunkSize=None):
+    """
+    Method that reads a headerless csv file with the multithreaded reader of 
+    pyarrow, which parses blocks of the file in parallel with explicit types.
+    The number of columns is taken from the first row of the file.
+    
+    Parameters
+    ----------
+    
+    path           : str or file object
+                     path of the file, or a stream of openRawFile
+                     
+    dtypes         : dictionary
+                     pandas dtypes {column index: 'Int64', 'float64', 'str' or 'category'}
+                     
+    skipInvalid    : boolean
+                     True, if the rows with a different number of columns are 
+                     skipped, an error is raised otherwise
+                     
+    chunkSize      : int
+                     number of rows per frame when the file is streamed, read at once if None
+                     
+    Return
+    ------
+    frame          : Pandas.Dataframe
+                     columns - column index, as pd.read_csv(header=None, dtype=dtypes) \n
+                     an iterator of the frames of chunkSize rows if chunkSize is given
+    """
+    arrowTypes = {'Int64': pa.int64(), 'float64': pa.float64(), 'str': pa.string(), \
+                  'category': pa.dictionary(pa.int32(), pa.string())}
+    
+    skipped = []
+    def skipRow(row):
+        skipped.append(row.number)
+        return 'skip'
+    
+    readOptions = pacsv.ReadOptions(autogenerate_column_names=True, use_threads=True)
+    parseOptions = pacsv.ParseOptions(invalid_row_handler=skipRow if skipInvalid else None)
+    convertOptions = pacsv.ConvertOptions(column_types={'f{}'.format(ind): arrowTypes[dtype] \
+                                                        for ind, dtype in dtypes.items()}, \
+                                          strings_can_be_null=True, quoted_strings_can_be_null=True)
+    if chunkSize is not None:
+        reader = pacsv.open_csv(path, read_options=readOptions, parse_options=parseOptions, \
+                                convert_options=convertOptions)
+        return _iterCsvArrow(reader, chunkSize, skipped, getattr(path, 'name', path))
+    
+    table = pacsv.read_csv(path, read_options=readOptions, parse_options=parseOptions, \
+                           convert_options=convertOptions)
+    if skipped != []:
+        print('{}: {} malformed rows are skipped'.format(getattr(path, 'name', path), len(skipped)))
+    return _arrowToFrame(table)
+
+
+def _iterCsvArrow(reader, chunkSize, skipped, name):
+    # the record batches of the streaming reader are regrouped to frames of chunkSize rows
+    batches = []
+    rows = 0
+    for batch in reader:
+        batches.append(batch)
+        rows += batch.num_rows
+        while rows >= chunkSize:
+            table = pa.Table.from_batches(batches)
+            yield _arrowToFrame(table.slice(0, chunkSize))
+            batches = table.slice(chunkSize).to_batches()
+            rows -= chunkSize
+    if rows > 0:
+        yield _arrowToFrame(pa.Table.from_batches(batches))
+    if skipped != []:
+        print('{}: {} malformed rows are skipped'.format(name, len(skipped)))
+        
+        
+def _arrowToFrame(table):
+    frame = table.to_pandas(types_mapper={pa.int64(): pd.Int64Dtype()}.get)
+    frame.columns = range(len(frame.columns))
+    # categories are sorted as pd.read_csv does, not in the order of appearance
+    for col in frame.columns:
+        if isinstance(frame[col].dtype, pd.CategoricalDtype):
+            frame[col] = frame[col].cat.reorder_categories(sorted(frame[col].cat.categories))
+    return frame
+
+
+def fileFingerprint(path, digest=True):
+    """
+    Method that gets the fingerprint of a file for the incident cache
+    
+    Parameters
+    ----------
+    
+    path           : str
+                     path of the file
+                     
+    digest         : boolean
+                     True, if the sha1 hash of the file contents is included
+                     
+    Return
+    ------
+    fingerprint    : dictionary
+                     {'size': int, 'mtime': float, 'sha1': str}
+    """
+    stat = os.stat(path)
+    fingerprint = {'size': stat.st_size, 'mtime': stat.st_mtime}
+    if digest:
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha1.update(block)
+        fingerprint['sha1'] = sha1.hexdigest()
+    return fingerprint
+
+
+def isFileChanged(path, cached):
+    """
+    Method that checks if a file differs from its fingerprint. The contents are
+    hashed only when the size is the same and the file has been touched.
+    When only the mtime differs (e.g. the file is copied again), the mtime of 
+    the fingerprint is refreshed in place, so the file is not hashed again 
+    once the refreshed fingerprint is saved.
+    
+    Parameters
+    ----------
+    
+    path           : str
+                     path of the file
+                     
+    cached         : dictionary
+                     fingerprint of fileFingerprint, or None, updated in place
+                     
+    Return
+    ------
+    changed        : boolean
+                     True, if the file is new, missing or changed
+    """
+    if cached is None or not os.path.exists(path):
+        return True
+    current = fileFingerprint(path, digest=False)
+    if current['size'] != cached['size']:
+        return True
+    if current['mtime'] == cached['mtime']:
+        return False
+    if fileFingerprint(path)['sha1'] != cached['sha1']:
+        return True
+    cached['mtime'] = current['mtime']
+    return False
+
+
+def matchDetailId(recordIds, detailRecordIds, detailIds):
+    """
+    Method that joins detail ids to incident ids by a sort-merge of the two
+    id arrays. The output is in a compressed sparse row form where the detail
+    ids of recordIds[i] are detailIds[offsets[i]:offsets[i+1]]
+    
+    Parameters
+    ----------
+    
+    recordIds       : array-like (int)
+                      unique incident ids of the records
+                      
+    detailRecordIds : array-like (int)
+                      incident id of each detail row
+                      
+    detailIds       : array-like (int)
+                      detail id of each detail row
+                      
+    Return
+    ------
+    offsets         : numpy.array(int64)
+                      len(recordIds) + 1 offsets to the matched detail ids
+                      
+    matchedIds      : numpy.array(int64)
+                      detail ids ordered by the position of their incident
+    """
+    recordIds = np.asarray(recordIds, dtype='int64')
+    detailRecordIds = np.asarray(detailRecordIds, dtype='int64')
+    detailIds = np.asarray(detailIds, dtype='int64')
+    
+    recordOrder = np.argsort(recordIds, kind='mergesort')
+    sortedIds = recordIds[recordOrder]
+    
+    # position of the incident of each detail row, the rows of unknown incidents are dropped
+    pos = np.searchsorted(sortedIds, detailRecordIds)
+    matched = pos < len(sortedIds)
+    matched[matched] = sortedIds[pos[matched]] == detailRecordIds[matched]
+    recordPos = recordOrder[pos[matched]]
+    
+    detailOrder = np.argsort(recordPos, kind='mergesort')
+    matchedIds = detailIds[matched][detailOrder]
+    
+    offsets = np.zeros(len(recordIds) + 1, dtype='int64')
+    np.cumsum(np.bincount(recordPos, minlength=len(recordIds)), out=offsets[1:])
+    return offsets, matchedIds
+
+
+class ColumnSchema():
+    """
+    Column metadata of the CHP incident files, parsed from the column-name 
+    workbook. Use ColumnSchema.get, which parses the workbook once per process
+    and again only when the workbook changes.
+    
+    Parameters
+    ----------
+    
+    path:               str
+                        path of the column-name workbook
+                        
+    Attributes
+    ----------
+    
+    colNameFileRecord:  Pandas.Dataframe
+                        meta information of the incident data
+                        
+    colNameFileDetail:  Pandas.Dataframe
+                        meta information of the incident detailed data
+                        
+    recordDtypes:       dictionary
+                        pandas dtypes of the incident data for read_csv,
+                        the columns of C.CATEGORY_COLUMNS are read as categoricals
+                        {column index: dtype}
+                        
+    detailDtypes:       dictionary
+                        pandas dtypes of the incident detailed data for read_csv,
+                        every column is read as text and validated after reading
+                        {column index: dtype}
+    """
+    _registry = {} # {path: ColumnSchema}
+    
+    def __init__(self, path):
+        self.path = path
+        self.mtime = os.stat(path).st_mtime
+        
+        sheets = pd.read_excel(path, sheet_name = [C.SHEET_RECORD, C.SHEET_DETAIL], header=None)
+        self.colNameFileRecord = sheets[C.SHEET_RECORD]
+        self.colNameFileDetail = sheets[C.SHEET_DETAIL]
+        
+        self.recordDtypes = {ind: C.TYPES_CSV[ty] for ind, ty in enumerate(self.colNameFileRecord[2])}
+        for ind in C.CATEGORY_COLUMNS:
+            self.recordDtypes[ind] = 'category'
+        self.detailDtypes = {ind: C.TYPES_CSV['str'] for ind in range(len(self.colNameFileDetail))}
+    
+    @classmethod
+    def get(cls, path=None):
+        """
+        Method that gets the schema of a workbook from the process-wide registry
+        """
+        if path is None:
+            path = C.RAW + C.DIR_COLNAME
+        schema = cls._registry.get(path)
+        if schema is None or schema.mtime != os.stat(path).st_mtime:
+            schema = cls(path)
+            cls._registry[path] = schema
+        return schema
+    
+    def getColumnDict(self, kind, columns):
+        """
+        Method that validates the column labels of a raw file against the 
+        schema and gets the meta information {column index: tuple(column name, type)}
+        
+        kind:   'record' or 'detail'
+        """
+        if kind == 'record':
+            colNameFile = self.colNameFileRecord
+            if len(columns) != len(colNameFile):
+                raise ValueError('The incident file has {} columns, but {} columns are defined in {}'.format(\
+                                 len(columns), len(colNameFile), self.path))
+        else:
+            colNameFile = self.colNameFileDetail
+            if len(columns) < len(colNameFile):
+                raise ValueError('The incident detail file has {} columns, but {} columns are defined in {}'.format(\
+                                 len(columns), len(colNameFile), self.path))
+        
+        return {ind:(col, ty) for ind, col, ty in zip(columns, colNameFile[0], colNameFile[2])}
+    
+    
+class RuleSet():
+    """
+    Declarative classification rules of the incidents (see C.RULES).
+    Each rule becomes a boolean record column. The conditions are evaluated 
+    as vectorized masks, once per distinct value of a categorical column, 
+    and the text of each column is prepared once for all rules.
+    
+    Parameters
+    ----------
+    
+    rules:              list
+                        [{'name': str, 'column': int, 'any': [(kind, column, values)], 'exclude': [name]}],
+                        C.RULES if None
+                        
+    Attributes
+    ----------
+    
+    rules:              list
+                        the rules in the order of evaluation
+    """
+    KINDS = ['prefix', 'keyword', 'pattern']
+    
+    def __init__(self, rules=None):
+        if rules is None:
+            rules = C.RULES
+        self.rules = [dict(rule) for rule in rules]
+        
+        names = []
+        for rule in self.rules:
+            assert(rule['name'] not in names), 'rule {} is defined twice'.format(rule['name'])
+            for name in rule.get('exclude', []):
+                assert(name in names), 'rule {} excludes {}, which is not defined before'.format(rule['name'], name)
+            for kind, column, values in rule['any']:
+                assert(kind in self.KINDS), 'unknown condition {} of rule {}'.format(kind, rule['name'])
+            names.append(rule['name'])
+    
+    @property
+    def names(self):
+        return [rule['name'] for rule in self.rules]
+    
+    def toJson(self):
+        """
+        Method that gets the rules as a json string, to compare rule sets
+        """
+        return json.dumps(self.rules)
+    
+    def _select(self, names):
+        # the excluded rules are evaluated with the rules excluding them
+        if names is None:
+            return list(self.rules)
+        selected = set(names)
+        for rule in reversed(self.rules):
+            if rule['name'] in selected:
+                selected.update(rule.get('exclude', []))
+        return [rule for rule in self.rules if rule['name'] in selected]
+    
+    def usesDetail(self, names=None):
+        """
+        Method that checks if the detail messages are needed for the rules
+        """
+        return any(column == 'detail' for rule in self._select(names) for kind, column, values in rule['any'])
+    
+    def getDetailConditions(self):
+        """
+        Method that gets the conditions over the detail messages [(kind, values)]
+        """
+        conditions = []
+        for rule in self.rules:
+            for kind, column, values in rule['any']:
+                if column == 'detail' and (kind, tuple(values)) not in conditions:
+                    conditions.append((kind, tuple(values)))
+        return conditions
+    
+    def matchDetail(self, dataDetail):
+        """
+        Method that matches the detail messages (3) with the detail conditions, 
+        so the rules are evaluated without the messages (see evaluate)
+        
+        Return
+        ------
+        hits:           dictionary
+                        {(kind, values): numpy.array(bool)} True, if a detail row matches
+        """
+        texts = dataDetail[3]
+        codes = None
+        if isinstance(texts.dtype, pd.CategoricalDtype):
+            texts, codes = pd.Series(texts.cat.categories.values).astype(str), texts.cat.codes.values
+        else:
+            texts = texts.astype(str)
+        hits = {}
+        for kind, values in self.getDetailConditions():
+            matched = self._match(kind, texts, values)
+            hits[(kind, values)] = matched if codes is None else matched[codes]
+        return hits
+    
+    @staticmethod
+    def _match(kind, texts, values):
+        if kind == 'prefix':
+            return texts.str.startswith(tuple(values)).values
+        if kind == 'keyword':
+            texts = texts.str.lower()
+            return np.logical_or.reduce([texts.str.contains(value.lower(), regex=False).values for value in values])
+        return np.logical_or.reduce([texts.str.contains(value, case=False, regex=True).values for value in values])
+    
+    def evaluate(self, dataRecord, dataDetail=None, names=None, detailHits=None):
+        """
+        Method that evaluates the rules over the records
+        
+        Parameters
+        ----------
+        
+        dataRecord:     Pandas.Dataframe
+                        dataset of incidents (index - incident id)
+                        
+        dataDetail:     Pandas.Dataframe
+                        dataset of detailed incidents, needed if usesDetail and detailHits is None
+                        
+        names:          list
+                        names of the rules to evaluate, all if None
+                        
+        detailHits:     dictionary
+                        {(kind, values): numpy.array(int64)} incident ids whose messages match
+                        each detail condition, used instead of the messages of dataDetail
+                        
+        Return
+        ------
+        flags:          list
+                        [(rule, numpy.array(bool))] in the order of the rules
+        """
+        texts = {} # column: (text of each distinct value, codes of the rows or None)
+        def getTexts(column):
+            if column not in texts:
+                values = dataDetail[3] if column == 'detail' else dataRecord[column]
+                if isinstance(values.dtype, pd.CategoricalDtype):
+                    texts[column] = (pd.Series(values.cat.categories.values).astype(str), values.cat.codes.values)
+                else:
+                    texts[column] = (values.astype(str), None)
+            return texts[column]
+        
+        masks = {}
+        for rule in self._select(names):
+            mask = np.zeros(len(dataRecord), dtype=bool)
+            for kind, column, values in rule['any']:
+                if column == 'detail' and detailHits is not None:
+                    if (kind, tuple(values)) not in detailHits:
+                        raise ValueError('The detail messages are not kept for rule {}. '.format(rule['name']) + \
+                                         'Load the incidents with keepMessages=True.')
+                    mask |= dataRecord.index.isin(detailHits[(kind, tuple(values))])
+                    continue
+                columnTexts, codes = getTexts(column)
+                matched = self._match(kind, columnTexts, values)
+                if codes is not None:
+                    matched = matched[codes]
+                if column == 'detail': # a record is matched by any of its messages
+                    matched = dataRecord.index.isin(dataDetail[0].values[matched])
+                mask |= matched
+            for name in rule.get('exclude', []):
+                mask &= ~masks[name]
+            masks[rule['name']] = mask
+        
+        selected = self.names if names is None else names
+        return [(rule, masks[rule['name']]) for rule in self.rules if rule['name'] in selected]
+        
+        
 class Data():
     """
     Data preparation. Opens CHP incidents files in txt. format provided by PeMS.
-    Generates a set of dictionary variables of field names and datasets.
+    Keeps the records and the detailed records as column-oriented pandas 
+    dataframes and derives additional fields with whole-column operations.
     This class is inherited by Incidents class.
     
     Parameters
@@ -92,21 +765,42 @@ class Data():
     month:              float
                         month of interest
                         
+    cache:              boolean
+                        True, if the derived tables are read from / written to 
+                        the parquet cache in C.CACHE. An entry is rebuilt when 
+                        any of the source files changes.
+                        
+    chunkSize:          int
+                        number of rows per chunk when the detail file is streamed, 
+                        the whole detail file is read at once if None \n
+                        each chunk is reduced to its incident / detail ids, the hits of the 
+                        detail rules and the keyword postings of its messages, unless keepMessages
+                        
+    fields:             list
+                        derived fields computed at construction, all if None \n
+                        'detail_id' - column 20, 'hov' - column 21, \n
+                        'type' - columns 22, 23 (accident, hazard), \n
+                        'time' - columns 24 - 28 (year, month, day, hour, unixTime) \n
+                        The other fields are computed the first time they are required.
+                        The detail file is read only for 'detail_id' and 'hov'.
+                        
+    keepMessages:       boolean
+                        True, if the detail messages (3) are kept in dataDetail when the 
+                        detail file is streamed, e.g. to evaluate new detail rules later. 
+                        They are always kept when the whole file is read or with cache.
+                        
     Attributes
     ----------
                 
+    derivedFields:      set
+                        derived fields computed so far
+                        
     colNameFileRecord:  Pandas.Dataframe
                         meta information of the incident data
                         
     colNameFileDetail:  Pandas.Dataframe
                         meta information of the incident detailed data
                         
-    dataFileRecord:     Pandas.Dataframe
-                        dataset of incidents (yyyy_mm)
-    
-    dataFileDetail:     Pandas.Dataframe
-                        dataset of detailed incidents (yyyy_mm)
-                        
     colRecordDict:      dictionary
                         meta information of the incident data
                         {column index: tuple(column name, type)}
@@ -115,169 +809,448 @@ class Data():
                         meta information of the incident detailed data
                         {column index: tuple(column name, type)}
                         
-    dataRecordDict:     dictionary
+    dataRecord:         Pandas.Dataframe
                         dataset of incidents (yyyy_mm)
-                        {incident_id(float):{column index : value}}
+                        index - incident_id, columns - column index
+                        
+    dataDetail:         Pandas.Dataframe
+                        dataset of detailed incidents (yyyy_mm), read on first access
+                        index - detail_id, columns - column index
                         
-    dataDetailDict:     dictionary
-                        dataset of detailed incidents (yyyy_mm)
+    detailOffsets:      numpy.array(int64)
+                        offsets of the detail ids of each record (same order as dataRecord)
+                        
+    detailIds:          numpy.array(int64)
+                        detail ids matched to the records, 
+                        detailIds[detailOffsets[i]:detailOffsets[i+1]] for the i-th record
+                        
+    dataRecordDict:     dictionary (read-only)
+                        dataset of incidents (yyyy_mm) in the nested form
                         {incident_id(float):{column index : value}}
+                        
+    dataDetailDict:     dictionary (read-only)
+                        dataset of detailed incidents (yyyy_mm) in the nested form
+                        {detail_id(float):{column index : value}}
     
-    keyRecordSet:       set
+    keyRecordSet:       set (read-only)
                         unique set of incident_id's
     
-    keyDetailSet:       set
+    keyDetailSet:       set (read-only)
                         unique set of detail_id's
+                        
+    keywordIndex:       KeywordIndex (read-only)
+                        inverted index of the detail messages and the record 
+                        descriptions / locations, built on first use
     """
     
-    def __init__(self, year, month):
+    CACHE_VERSION = 4 # increase when the derivation of the cached tables changes
+    
+    # derived field: method computing the field
+    DERIVED_FIELDS = {'detail_id': '_setDetailId', 'hov': '_setHov', 'type': '_setType', \
+                      'time': '_setTime', 'flags': '_setFlags'}
+    # derived field: rules of the field, the other rules are evaluated as 'flags'
+    FIELD_RULES = {'hov': ['hov'], 'type': ['accident', 'hazard']}
+    
+    def __init__(self, year, month, cache=False, chunkSize=None, fields=None, keepMessages=False):
         self.year = year
         self.month = month
+        self.chunkSize = chunkSize
+        self.keepMessages = keepMessages or cache or chunkSize is None
+        self.derivedFields = set()
+        self._dataDetail = None
+        self._detailHits = None # {(kind, values): incident ids} when the messages are not kept
+        self._detailKeywordIndex = None
+        self._keywordIndex = None
+        self.ruleSet = RuleSet()
         
-        self.colNameFileRecord, self.colNameFileDetail = self._openColName()
-        self.dataFileRecord, self.dataFileDetail = self._openData()
+        if cache and self._readCache():
+            return
         
-
-        self.colRecordDict, self.colDetailDict  = self._getColumNames()
+        self.colNameFileRecord, self.colNameFileDetail = self._openColName()
+        dataFileRecord = self._openRecord()
         
+        self.dataRecord = self._getDataRecord(dataFileRecord)
+        self.colRecordDict = ColumnSchema.get().getColumnDict('record', dataFileRecord.columns)
+        # validated again with the columns of the detail file when it is read
+        self.colDetailDict = ColumnSchema.get().getColumnDict('detail', range(len(self.colNameFileDetail)))
+        del dataFileRecord
         
-        self.dataRecordDict= self._getDataRecordDict(self.dataFileRecord)
-        self.keyRecordSet = set(key for key in self.dataRecordDict) # time complexity - contain, remove O(1)
+        # the cache keeps the fully derived tables
+        if fields is None or cache:
+            fields = list(self.DERIVED_FIELDS)
+        self.require(*fields)
         
-        self.dataDetailDict = self._getDataDetailDict(self.dataFileDetail)
-        self.keyDetailSet = set(key for key in self.dataDetailDict)
+        if cache:
+            self._writeCache()
+            
+    def require(self, *fields):
+        """
+        Method that computes the derived fields which are not computed yet
         
-        self._setDetailId()
-        self._setHov()
-        self._setType()
-        self._setTime()
+        Parameters
+        ----------
         
+        fields:     str
+                    'detail_id', 'hov', 'type', 'time' or 'flags'
+        """
+        for field in fields:
+            assert(field in self.DERIVED_FIELDS)
+            if field not in self.derivedFields:
+                getattr(self, self.DERIVED_FIELDS[field])()
+                self.derivedFields.add(field)
+        self.colRecordDict = dict(sorted(self.colRecordDict.items()))
     
-    def _getColumNames(self):
-        colRecord = list(self.colNameFileRecord[0])
-        colDetail = list(self.colNameFileDetail[0])
+    def classify(self, ruleSet=None, names=None):
+        """
+        Method that evaluates classification rules to boolean record columns.
+        The rules are evaluated over the loaded columns, so the records are
+        reclassified without reading the raw files again.
+        
+        Parameters
+        ----------
         
-        typeRecord = list(self.colNameFileRecord[2])
-        typeDetail = list(self.colNameFileDetail[2])
+        ruleSet:    RuleSet
+                    rules to evaluate, replaces the rules of the dataset, 
+                    the current rules if None
+                    
+        names:      list
+                    names of the rules to evaluate, all if None
+        """
+        if ruleSet is not None:
+            self.ruleSet = ruleSet
+        dataDetail = self.dataDetail if self.ruleSet.usesDetail(names) else None
+        if self._detailHits is not None: # the messages are reduced to the hits
+            dataDetail = None
+        for rule, mask in self.ruleSet.evaluate(self.dataRecord, dataDetail, names, self._detailHits):
+            self.colRecordDict[rule['column']] = (rule['name'], 'boolean')
+            self.dataRecord[rule['column']] = mask
+        self.colRecordDict = dict(sorted(self.colRecordDict.items()))
+    
+    @property
+    def dataDetail(self):
+        if self._dataDetail is None:
+            self._loadDetail()
+        return self._dataDetail
+    
+    @dataDetail.setter
+    def dataDetail(self, dataDetail):
+        self._dataDetail = dataDetail
         
-        colRecordDict = {ind:(col, ty) for ind, col, ty in zip(self.dataFileRecord,colRecord, typeRecord)}
-        colDetailDict = {ind:(col, ty) for ind, col, ty in zip(self.dataFileDetail,colDetail, typeDetail)}
+    @property
+    def keywordIndex(self):
+        if self._keywordIndex is None:
+            dataDetail = self.dataDetail
+            if self._detailKeywordIndex is None and 3 not in dataDetail.columns:
+                raise ValueError('The detail messages are not kept. Load the incidents with keepMessages=True.')
+            self._keywordIndex = KeywordIndex.fromRecords(self.dataRecord, dataDetail, self._detailKeywordIndex)
+        return self._keywordIndex
+    
+    def getIdsByKeyword(self, phrase, sources=None):
+        """
+        Method that gets the incident ids whose detail messages, descriptions or 
+        locations include a word or a phrase (see KeywordIndex.getIds)
+        """
+        return self.keywordIndex.getIds(phrase, sources)
         
-        return colRecordDict, colDetailDict
-
+    @property
+    def dataRecordDict(self):
+        self.require(*self.DERIVED_FIELDS)
+        return self._toNestedDict(self.dataRecord)
+    
+    @property
+    def dataDetailDict(self):
+        return frameToNestedDict(self.dataDetail)
+    
+    @property
+    def keyRecordSet(self):
+        return set(self.dataRecord.index)
+    
+    @property
+    def keyDetailSet(self):
+        return set(self.dataDetail.index)
+    
+    def _getDetailHits(self):
+        # {(kind, values): incident ids} of the detail conditions, matched with the messages if they are kept
+        if self._detailHits is not None:
+            return self._detailHits
+        dataDetail = self.dataDetail
+        return {condition: np.unique(dataDetail[0].values[hits].astype('int64')) \
+                for condition, hits in self.ruleSet.matchDetail(dataDetail).items()}
+    
+    def getDetailIds(self, incId):
+        """
+        Method that gets the detail ids matched to an incident id
+        """
+        self.require('detail_id')
+        pos = self.dataRecord.index.get_loc(incId)
+        return self.detailIds[self.detailOffsets[pos]:self.detailOffsets[pos+1]]
+    
+    def _toNestedDict(self, frame):
+        # the detail ids (column 20) are added back as sets
+        detail_id = 20
+        frame = frame.copy()
+        pos = self.dataRecord.index.get_indexer(frame.index)
+        frame[detail_id] = [set(self.detailIds[self.detailOffsets[p]:self.detailOffsets[p+1]].tolist()) \
+                            if self.detailOffsets[p] != self.detailOffsets[p+1] else '' for p in pos]
+        return frameToNestedDict(frame[[col for col in self.colRecordDict if col in frame.columns]])
+    
+    @staticmethod
+    def getSourcePaths(year, month):
+        """
+        Method that gets the paths of the raw files of a month {'record', 'detail', 'colName': path},
+        a compressed copy is taken when the text file does not exist
+        """
+        recordPath = resolveRawPath('{}{}\\{}{}_{:02}.txt'.format(C.RAW, year, C.DIR_RECORD, year, month))
+        detailPath = resolveRawPath('{}{}\\{}{}_{:02}.txt'.format(C.RAW, year, C.DIR_DETAIL, year, month))
+        return {'record': recordPath, 'detail': detailPath, 'colName': C.RAW+C.DIR_COLNAME}
+    
+    def _sourcePaths(self):
+        return self.getSourcePaths(self.year, self.month)
 
     def _openColName(self):
-        colNameRecord = pd.read_excel(C.RAW+C.DIR_COLNAME, \
-                                      sheet_name = C.SHEET_RECORD, header=None)
-        colNameDetail = pd.read_excel(C.RAW+C.DIR_COLNAME, \
-                                      sheet_name = C.SHEET_DETAIL, header=None)
-        return colNameRecord, colNameDetail
-    
-    
-    def _openData(self):
-        
-        dataRecord_txt = pd.read_csv('{}{}\\{}{}_{:02}.txt'.format(\
-                                     C.RAW, self.year, C.DIR_RECORD, self.year, self.month), header=None)
-        dataDetail_txt = pd.read_csv('{}{}\\{}{}_{:02}.txt'.format(\
-                                     C.RAW, self.year, C.DIR_DETAIL, self.year, self.month), header=None)
-        return dataRecord_txt, dataDetail_txt
-
-
-    def _getDataRecordDict(self, dataFileRecord):
-            dataRecordDict = {}
-            for row in dataFileRecord.values:
-                rowDict = {}
-                rowList = list(row)
-                for ind, val in enumerate(rowList): 
-                    if ind != 0: # except record id
-                        if type(val) == float and math.isnan(val):
-                            val=-1
-                        rowDict[ind] = val
-                dataRecordDict[rowList[0]] = rowDict
-            return dataRecordDict
-
-    def _getDataDetailDict(self, dataFileDetail):
-        dataDetailDict = {}
-        for row in dataFileDetail.values:
-            rowDict = {}
-#            if row[0][:8].isdigit(): # check if the first 8 characters are numbers
-            if type(row[0]) == str:
-                if row[0].isdigit():
-                    if getDigit(int(row[0])) == 8: # check if the first value is 8-digit number
-                        rowList = list(row)
-                        for ind, val in enumerate(rowList):
-                            if ind != 1: # except for detail id
-                                rowDict[ind] = val
-                        dataDetailDict[rowList[1]] = rowDict
-            elif type(row[0]) == float:
-                if not math.isnan(row[0]):
-                    if getDigit(int(row[0])) == 8: # check if the first value is 8-digit number
-                            rowList = list(row)
-                            for ind, val in enumerate(rowList):
-                                if ind != 1: # except for detail id
-                                    rowDict[ind] = val
-                            dataDetailDict[rowList[1]] = rowDict
-        return dataDetailDict
-
-    
-    def _matchingDetailMessage(self):
-        copyKeyRecordSet = copy.deepcopy(self.keyRecordSet)
-        keyRecordDetailDict = {}
-        for key, valDict in self.dataDetailDict.items():
-            keyRec = valDict[0]
-            keyDet = key
-            if int(keyRec) in copyKeyRecordSet: # check if the key exists in the dictionary
-                keyRecordDetailDict[int(keyRec)] = set([int(keyDet)])
-                copyKeyRecordSet.remove(int(keyRec))
-            else:
-                if int(keyRec) in self.keyRecordSet: # check if the key exists in record data
-                    keyRecordDetailDict[int(keyRec)].add(int(keyDet))
-        return keyRecordDetailDict
+        schema = ColumnSchema.get()
+        return schema.colNameFileRecord, schema.colNameFileDetail
+    
+    
+    def _openRecord(self):
+        # a compressed file is opened again for the fallback, as its stream is consumed
+        paths = self._sourcePaths()
+        recordDtypes = ColumnSchema.get().recordDtypes
+        if C.CSV_READER == 'pyarrow' and pa is not None:
+            try:
+                return readCsvArrow(openRawFile(paths['record']), recordDtypes)
+            except pa.ArrowInvalid as e: # e.g. a value of a wrong type
+                print('{} is read again with pandas: {}'.format(paths['record'], e))
+        return pd.read_csv(openRawFile(paths['record']), header=None, dtype=recordDtypes)
+    
+    def _openDetail(self):
+        paths = self._sourcePaths()
+        detailDtypes = ColumnSchema.get().detailDtypes
+        if self.chunkSize is None:
+            if C.CSV_READER == 'pyarrow' and pa is not None:
+                # malformed detail rows are skipped, the remaining rows are validated in _filterDetail
+                try:
+                    return readCsvArrow(openRawFile(paths['detail']), detailDtypes, skipInvalid=True)
+                except pa.ArrowInvalid as e:
+                    print('{} is read again with pandas: {}'.format(paths['detail'], e))
+            return pd.read_csv(openRawFile(paths['detail']), header=None, dtype=detailDtypes, on_bad_lines='warn')
+        # the detail rows are streamed in chunks of chunkSize rows, 
+        # the rows with another number of columns than the first row are skipped
+        if C.CSV_READER == 'pyarrow' and pa is not None:
+            return readCsvArrow(openRawFile(paths['detail']), detailDtypes, skipInvalid=True, chunkSize=self.chunkSize)
+        # the c parser of pandas keeps a malformed row starting a chunk, the python parser skips it
+        return pd.read_csv(openRawFile(paths['detail']), header=None, dtype=detailDtypes, engine='python', \
+                           chunksize=self.chunkSize, on_bad_lines='warn')
+    
+    def _loadDetail(self):
+        if self.year is None:
+            raise ValueError('The detail file of combined incidents cannot be read. ' + \
+                             'Request the fields when loading the months.')
+        self._dataDetail, detailColumns = self._getDataDetail(self._openDetail())
+        self.colDetailDict = ColumnSchema.get().getColumnDict('detail', detailColumns)
 
-    def _setDetailId(self):
-        keyRecordDetailDict = self._matchingDetailMessage()
-        detail_id = 20
-        self.colRecordDict[detail_id] = ('detail_id', 'set')
-        for key in self.keyRecordSet:
-            self.dataRecordDict[key][detail_id] = ''
-        for key, val in keyRecordDetailDict.items():
-            self.dataRecordDict[key][detail_id] = val 
 
-    def _setHov(self):
-        hov = 21
-        self.colRecordDict[hov] = ('hov', 'boolean')
-        hovSet = set([int(rec[0]) for rec in self.dataDetailDict.values() if 'hov' in str(rec[3]).lower()])
-        hovSet1 = set([key for key, rec in self.dataRecordDict.items() if 'hov' in str(rec[5]).lower()])
+    def _cachePaths(self):
+        prefix = '{}{}_{:02}'.format(C.CACHE, self.year, self.month)
+        return {'meta': prefix + '_meta.json', 'record': prefix + '_record.parquet', \
+                'detail': prefix + '_detail.parquet', 'word': prefix + '_word.parquet', \
+                'doc': prefix + '_doc.parquet'}
+    
+    def _isCacheValid(self, meta):
+        if meta.get('version') != self.CACHE_VERSION:
+            return False
+        return not any(isFileChanged(path, meta['sources'].get(key)) \
+                       for key, path in self._sourcePaths().items())
+    
+    def _readCache(self):
+        paths = self._cachePaths()
+        if pa is None or not os.path.exists(paths['meta']):
+            return False
+        with open(paths['meta']) as f:
+            meta = json.load(f)
+        mtimes = {key: source['mtime'] for key, source in meta['sources'].items()}
+        if not self._isCacheValid(meta):
+            return False
+        # the refreshed mtimes of the unchanged files are saved, so they are not hashed in the next load
+        if any(source['mtime'] != mtimes[key] for key, source in meta['sources'].items()):
+            with open(paths['meta'] + '.tmp', 'w') as f:
+                json.dump(meta, f)
+            os.replace(paths['meta'] + '.tmp', paths['meta'])
+        
+        self.colNameFileRecord = pd.DataFrame(meta['colNameFileRecord'])
+        self.colNameFileDetail = pd.DataFrame(meta['colNameFileDetail'])
+        self.colRecordDict = {int(key): tuple(val) for key, val in meta['colRecordDict']}
+        self.colDetailDict = {int(key): tuple(val) for key, val in meta['colDetailDict']}
+        
+        # detail ids are stored as a list column, which is the same CSR layout
+        recordTable = pq.read_table(paths['record'])
+        detailIdList = recordTable.column('20').combine_chunks()
+        self.detailOffsets = detailIdList.offsets.to_numpy().astype('int64')
+        self.detailIds = detailIdList.values.to_numpy().astype('int64')
+        self.dataRecord = self._fromCacheFrame(recordTable.drop(['20']).to_pandas(), meta['textRecord'])
+        self.dataDetail = self._fromCacheFrame(pq.read_table(paths['detail']).to_pandas(), meta['textDetail'])
+        self._keywordIndex = KeywordIndex.fromTables(pq.read_table(paths['word']), pq.read_table(paths['doc']))
+        self.derivedFields = set(self.DERIVED_FIELDS)
+        
+        # the cached columns are reclassified when the rules have changed
+        if meta['rules'] != self.ruleSet.toJson():
+            self.classify()
+        return True
+    
+    def _writeCache(self):
+        if pa is None:
+            return
+        paths = self._cachePaths()
+        os.makedirs(C.CACHE, exist_ok=True) # workers of loadIncidents can create it at once
         
-        for hov1 in hovSet1:
-            hovSet.add(hov1)
+        recordFrame, textRecord = self._toCacheFrame(self.dataRecord)
+        detailFrame, textDetail = self._toCacheFrame(self.dataDetail)
+        recordTable = pa.Table.from_pandas(recordFrame)
+        detailIdList = pa.ListArray.from_arrays(pa.array(self.detailOffsets.astype('int32')), pa.array(self.detailIds))
+        recordTable = recordTable.append_column('20', detailIdList)
         
-        for key in self.keyRecordSet:
-            if key in hovSet:
-                self.dataRecordDict[key][hov] = True
+        meta = {'version': self.CACHE_VERSION, \
+                'sources': {key: fileFingerprint(path) for key, path in self._sourcePaths().items()}, \
+                'colNameFileRecord': self.colNameFileRecord.values.tolist(), \
+                'colNameFileDetail': self.colNameFileDetail.values.tolist(), \
+                'colRecordDict': [[key, list(val)] for key, val in self.colRecordDict.items()], \
+                'colDetailDict': [[key, list(val)] for key, val in self.colDetailDict.items()], \
+                'textRecord': textRecord, 'textDetail': textDetail, \
+                'rules': self.ruleSet.toJson()}
+        
+        # the meta file is published last so that an interrupted write is never read
+        # the old meta file is removed first, so the old meta never sits next to new data files
+        pq.write_table(recordTable, paths['record'] + '.tmp')
+        pq.write_table(pa.Table.from_pandas(detailFrame), paths['detail'] + '.tmp')
+        wordTable, docTable = self.keywordIndex.toTables()
+        pq.write_table(wordTable, paths['word'] + '.tmp')
+        pq.write_table(docTable, paths['doc'] + '.tmp')
+        with open(paths['meta'] + '.tmp', 'w') as f:
+            json.dump(meta, f)
+        if os.path.exists(paths['meta']):
+            os.remove(paths['meta'])
+        for key in ['record', 'detail', 'word', 'doc', 'meta']:
+            os.replace(paths[key] + '.tmp', paths[key])
+            
+    @staticmethod
+    def _toCacheFrame(frame):
+        # text columns hold -1 for missing values, which is stored as null
+        # categoricals are stored as dictionary columns
+        textColumns = [col for col in frame.columns \
+                       if frame[col].dtype == object or isinstance(frame[col].dtype, pd.CategoricalDtype)]
+        frame = frame.copy()
+        for col in textColumns:
+            if isinstance(frame[col].dtype, pd.CategoricalDtype):
+                if -1 in frame[col].cat.categories:
+                    frame[col] = frame[col].cat.remove_categories([-1])
             else:
-                self.dataRecordDict[key][hov] = False        
+                frame[col] = frame[col].where(frame[col].ne(-1), None)
+        frame.columns = [str(col) for col in frame.columns]
+        return frame, textColumns
+        
+    @staticmethod
+    def _fromCacheFrame(frame, textColumns):
+        frame.columns = [int(col) for col in frame.columns]
+        for col in textColumns:
+            if isinstance(frame[col].dtype, pd.CategoricalDtype):
+                frame[col] = Data._fillCategory(frame[col])
+            else:
+                frame[col] = frame[col].astype(object).where(frame[col].notna(), -1)
+        return frame
+    
+    @staticmethod
+    def _fillCategory(column):
+        # -1 is added as a category of its own only when a value is missing
+        if column.isna().any():
+            column = column.cat.add_categories([-1]).fillna(-1)
+        return column
+    
+    def _getDataRecord(self, dataFileRecord):
+        dataRecord = dataFileRecord.set_index(0)
+        dataRecord.index = dataRecord.index.astype('int64')
+        dataRecord.index.name = None
+        # the last row wins when an incident id is duplicated
+        dataRecord = dataRecord[~dataRecord.index.duplicated(keep='last')]
+        for col in dataRecord.columns:
+            if isinstance(dataRecord[col].dtype, pd.CategoricalDtype):
+                dataRecord[col] = self._fillCategory(dataRecord[col].cat.remove_unused_categories())
+        return dataRecord.fillna(-1) # missing values are marked as -1
+
+    def _getDataDetail(self, dataFileDetail):
+        if isinstance(dataFileDetail, pd.DataFrame):
+            return self._filterDetail(dataFileDetail), list(dataFileDetail.columns)
+        
+        # only the validated rows of each chunk are kept, so the raw text of at most one chunk is held at a time.
+        # Unless the messages are kept, each chunk is reduced to its ids, the detail rule hits of each row 
+        # and the keyword postings of its messages, which are merged after the duplicated detail ids are dropped
+        detailColumns = []
+        dataDetailList = []
+        conditions = self.ruleSet.getDetailConditions()
+        hitList = {condition: [] for condition in conditions}
+        indexList = []
+        for chunk in dataFileDetail:
+            if len(chunk.columns) > len(detailColumns):
+                detailColumns = list(chunk.columns)
+            dataDetail = self._filterDetail(chunk)
+            del chunk
+            if not self.keepMessages:
+                for condition, hits in self.ruleSet.matchDetail(dataDetail).items():
+                    hitList[condition].append(hits)
+                indexList.append(KeywordIndex.fromDetail(dataDetail))
+                dataDetail = dataDetail.drop(columns=3)
+            dataDetailList.append(dataDetail)
+        if dataDetailList == []:
+            columns = [0, 2, 3] if self.keepMessages else [0, 2]
+            dataDetailList = [pd.DataFrame(columns=columns, index=pd.Index([], dtype='int64'))]
+        
+        dataDetail = pd.concat(dataDetailList)
+        del dataDetailList
+        # the last row wins when a detail id is duplicated
+        keep = ~dataDetail.index.duplicated(keep='last')
+        if not self.keepMessages:
+            incId = dataDetail[0].values.astype('int64')
+            hitList = {condition: np.concatenate(hits + [np.zeros(0, dtype=bool)]) for condition, hits in hitList.items()}
+            self._detailHits = {condition: np.unique(incId[keep & hits]) for condition, hits in hitList.items()}
+            self._detailKeywordIndex = KeywordIndex.merge(indexList, keep)
+        return dataDetail[keep], detailColumns
+        
+    @staticmethod
+    def _filterDetail(dataFileDetail):
+        firstCol = dataFileDetail[0]
+        if firstCol.dtype.kind not in 'iuf': # text column, only digits are accepted
+            isDigit = firstCol.str.isdigit().fillna(False).astype(bool)
+            firstCol = firstCol.where(isDigit)
+        incId = np.floor(pd.to_numeric(firstCol, errors='coerce'))
+        detId = pd.to_numeric(dataFileDetail[1], errors='coerce')
+        
+        # check if the first value is 8-digit number
+        valid = (incId >= 10**7) & (incId < 10**8) & detId.notna()
+        
+        dataDetail = dataFileDetail[valid].copy()
+        dataDetail[0] = incId[valid].astype('int64')
+        dataDetail.index = detId[valid].astype('int64').values
+        dataDetail = dataDetail.drop(columns=1)
+        # the last row wins when a detail id is duplicated
+        return dataDetail[~dataDetail.index.duplicated(keep='last')]
+
+    def _setDetailId(self):
+        detail_id = 20
+        self.colRecordDict[detail_id] = ('detail_id', 'set')
+        
+        self.detailOffsets, self.detailIds = matchDetailId(self.dataRecord.index.values, \
+                                                           self.dataDetail[0].values, self.dataDetail.index.values)
+
+    def _setHov(self):
         # A gap exists between # of incident keys in record and detailed datasets.
         # The record dataset cannot fully cover the cases of the detailed dataset.
+        self.classify(names=[name for name in self.FIELD_RULES['hov'] if name in self.ruleSet.names])
         
     def _setType(self): 
-        accident = 22
-        hazard = 23
-        self.colRecordDict[accident] = ('accident', 'boolean')
-        self.colRecordDict[hazard] = ('hazard', 'boolean')
-        
-        accidentCodes = set('1179 1180 1181 1182 1183 2000'.split(sep= ' '))
-        hazardCodes = set('1125'.split(sep= ' '))
-        for key, val in self.dataRecordDict.items():
-            if val[4][:4] in accidentCodes:
-                self.dataRecordDict[key][accident] = True
-                self.dataRecordDict[key][hazard] = False
-            elif val[4][:4] in hazardCodes:
-                self.dataRecordDict[key][accident] = False
-                self.dataRecordDict[key][hazard] = True
-            else:
-                self.dataRecordDict[key][accident] = False
-                self.dataRecordDict[key][hazard] = False
+        self.classify(names=[name for name in self.FIELD_RULES['type'] if name in self.ruleSet.names])
+        
+    def _setFlags(self):
+        fieldRules = [name for names in self.FIELD_RULES.values() for name in names]
+        self.classify(names=[name for name in self.ruleSet.names if name not in fieldRules])
                 
     def _setTime(self):
         year = 24
@@ -292,31 +1265,437 @@ class Data():
         self.colRecordDict[hour] = ('hour', 'int')
         self.colRecordDict[unixTime] = ('unixTime', 'int') # in PST/ You have to add 28800(or 25200) to get UTC
         
-        for key, val in self.dataRecordDict.items():
-            timeList = self._splitTime(val[3])
-            self.dataRecordDict[key][year] = timeList[0]
-            self.dataRecordDict[key][month] = timeList[1]
-            self.dataRecordDict[key][day] = timeList[2]
-            self.dataRecordDict[key][hour] = timeList[3]
-            
-            # in case of invalid time
-            if timeList == [-1] * 6:
-                self.dataRecordDict[key][unixTime] = -1
-            else:
-                self.dataRecordDict[key][unixTime] = getUnixTime(timeList)
-            
+        timeDict = splitTimeArray(self.dataRecord[3])
+        self.dataRecord[year] = timeDict['year']
+        self.dataRecord[month] = timeDict['month']
+        self.dataRecord[day] = timeDict['day']
+        self.dataRecord[hour] = timeDict['hour']
+        self.dataRecord[unixTime] = timeDict['unixTime']
+    
+    
+class CategoryIndex():
+    """
+    Index of the records by facility type (hov / ml) and incident type 
+    (accident / hazard / others), built once at load.
+    The flags are kept as packed bitsets, and the record positions are 
+    grouped by the six disjoint cells (facility x incident type) so that any
+    combination is a few contiguous slices.
+    
+    Parameters
+    ----------
+    
+    hov:                numpy.array(bool) or None
+                        hov flag of each record (column 21), 
+                        None if only the facility type 'All' is queried
+    
+    accident:           numpy.array(bool)
+                        accident flag of each record (column 22)
+                        
+    hazard:             numpy.array(bool)
+                        hazard flag of each record (column 23)
+                        
+    Attributes
+    ----------
+    
+    size:               int
+                        number of records
+                        
+    hasHov:             boolean
+                        True, if the facility types can be queried
+    
+    bitsets:            dictionary
+                        packed flags {'hov', 'ml', 'accident', 'hazard', 'others' : numpy.array(uint8)}
+                        
+    cell:               numpy.array(int8)
+                        cell of each record, facility*3 + incident type
+                        
+    order:              numpy.array(int64)
+                        record positions sorted by cell
+                        
+    offsets:            numpy.array(int64)
+                        start of each cell in the order, cell = facility*3 + incident type
+    """
+    INC_TYPES = ['accident', 'hazard', 'others']
+    FACIL_TYPES = ['hov', 'ml']
+    
+    def __init__(self, hov, accident, hazard):
+        accident = np.asarray(accident, dtype=bool)
+        hazard = np.asarray(hazard, dtype=bool) & ~accident
+        others = ~accident & ~hazard
         
-    def _splitTime(self, time):
-        try:
-            timeList = time.split(' ')
-        except:
-            mmddyyyy = [-1, -1, -1]
-            hhmmss = [-1, -1, -1]
-        else:
-            mmddyyyy = timeList[0].split('/')
-            hhmmss = timeList[1].split(':')
+        self.size = len(accident)
+        self.bitsets = {'accident': np.packbits(accident), 'hazard': np.packbits(hazard), 'others': np.packbits(others)}
+        
+        self.hasHov = hov is not None
+        if self.hasHov:
+            hov = np.asarray(hov, dtype=bool)
+            self.bitsets['hov'] = np.packbits(hov)
+            self.bitsets['ml'] = np.packbits(~hov)
+        else: # every record is put in the ml cells
+            hov = np.zeros(self.size, dtype=bool)
+        
+        self.cell = ((~hov).astype('int8')*3 + np.where(accident, 0, np.where(hazard, 1, 2))).astype('int8')
+        self.order = np.argsort(self.cell, kind='mergesort')
+        self.offsets = np.zeros(len(self.INC_TYPES)*len(self.FACIL_TYPES) + 1, dtype='int64')
+        np.cumsum(np.bincount(self.cell, minlength=len(self.offsets) - 1), out=self.offsets[1:])
+    
+    def _cells(self, incType, facilType):
+        incType = incType.lower()
+        facilType = facilType.lower()
+        assert(incType in self.INC_TYPES + ['all'] and facilType in self.FACIL_TYPES + ['all'])
+        assert(self.hasHov or facilType == 'all')
+        
+        incCodes = range(len(self.INC_TYPES)) if incType == 'all' else [self.INC_TYPES.index(incType)]
+        facilCodes = range(len(self.FACIL_TYPES)) if facilType == 'all' else [self.FACIL_TYPES.index(facilType)]
+        return [facil*3 + inc for facil in facilCodes for inc in incCodes]
+    
+    def count(self, incType='All', facilType='All'):
+        """
+        Method that gets the number of records of a combination
+        """
+        return int(sum(self.offsets[cell+1] - self.offsets[cell] for cell in self._cells(incType, facilType)))
+    
+    def getPositions(self, incType='All', facilType='All'):
+        """
+        Method that gets the positions of the records of a combination in ascending order
+        """
+        cells = self._cells(incType, facilType)
+        if len(cells) == len(self.offsets) - 1:
+            return np.arange(self.size)
+        positions = [self.order[self.offsets[cell]:self.offsets[cell+1]] for cell in cells]
+        if len(positions) == 1:
+            return positions[0]
+        return np.sort(np.concatenate(positions))
+    
+    def getMask(self, incType='All', facilType='All'):
+        """
+        Method that gets the boolean mask of a combination over the records
+        """
+        mask = np.ones(self.size, dtype=bool)
+        for flag in [incType.lower(), facilType.lower()]:
+            if flag != 'all':
+                assert(flag in self.bitsets)
+                mask &= np.unpackbits(self.bitsets[flag], count=self.size).astype(bool)
+        return mask
+    
+    def filterPositions(self, positions, incType='All', facilType='All'):
+        """
+        Method that keeps the positions of the records of a combination in O(len(positions))
+        """
+        cellTable = np.zeros(len(self.offsets) - 1, dtype=bool)
+        cellTable[self._cells(incType, facilType)] = True
+        return positions[cellTable[self.cell[positions]]]
+    
+    
+class TimeIndex():
+    """
+    Index of the records by time. The records are sorted by unix time for 
+    range queries, and by (day of week, hour) buckets for bucket lookups. 
+    Both are answered with binary searches. Records of invalid time are excluded.
+    
+    Parameters
+    ----------
+    
+    unixTime:           numpy.array(int64)
+                        unix time of each record (column 28)
+    
+    year:               numpy.array(int64)
+                        year of each record (column 24)
+    
+    month:              numpy.array(int64)
+                        month of each record (column 25)
+    
+    day:                numpy.array(int64)
+                        day of each record (column 26)
+    
+    hour:               numpy.array(int64)
+                        hour of each record (column 27)
+                        
+    Attributes
+    ----------
+    
+    order:              numpy.array(int64)
+                        record positions sorted by unix time
+                        
+    sortedTime:         numpy.array(int64)
+                        unix time in the order
+                        
+    bucket:             numpy.array(int16)
+                        bucket of each record, day of week (0 - Monday)*24 + hour, -1 if invalid
+                        
+    bucketOrder:        numpy.array(int64)
+                        record positions sorted by bucket
+                        
+    bucketOffsets:      numpy.array(int64)
+                        start of each bucket in the bucket order
+    """
+    BUCKETS = 7*24
+    
+    def __init__(self, unixTime, year, month, day, hour):
+        unixTime = np.asarray(unixTime, dtype='int64')
+        self.order = np.argsort(unixTime, kind='mergesort')
+        self.sortedTime = unixTime[self.order]
+        
+        date = pd.to_datetime(pd.DataFrame({'year': year, 'month': month, 'day': day}), errors='coerce')
+        dayOfWeek = date.dt.dayofweek.fillna(-1).values.astype('int64')
+        valid = (dayOfWeek >= 0) & (unixTime != -1)
+        self.bucket = np.where(valid, dayOfWeek*24 + np.asarray(hour, dtype='int64'), -1).astype('int16')
+        
+        self.bucketOrder = np.argsort(self.bucket, kind='mergesort')
+        self.bucketOffsets = np.searchsorted(self.bucket[self.bucketOrder], np.arange(self.BUCKETS + 1))
+    
+    @staticmethod
+    def toUnixTime(timestamp):
+        """
+        Method that converts a timestamp (MM/DD/YYYY HH24:MI:SS) to the unix time of the records.
+        An integer is returned as it is.
+        """
+        if isinstance(timestamp, str):
+            dt = datetime.datetime.strptime(timestamp, '%m/%d/%Y %H:%M:%S')
+            return getUnixTime([dt.year, dt.month, dt.day, dt.hour, dt.minute, dt.second])
+        return int(timestamp)
+    
+    def getRange(self, start=None, end=None):
+        """
+        Method that gets the positions of the records in start <= time < end, 
+        sorted by time. start and end are unix times or timestamps.
+        """
+        # invalid time (-1) is always excluded
+        lo = 0 if start is None else max(self.toUnixTime(start), 0)
+        lo = np.searchsorted(self.sortedTime, lo, side='left')
+        hi = len(self.sortedTime) if end is None else np.searchsorted(self.sortedTime, self.toUnixTime(end), side='left')
+        return self.order[lo:max(lo, hi)]
+    
+    def _bucketTable(self, hours=None, days=None):
+        hours = range(24) if hours is None else hours
+        days = range(7) if days is None else days
+        table = np.zeros(self.BUCKETS, dtype=bool)
+        for day in days:
+            for hour in hours:
+                table[day*24 + hour] = True
+        return table
+    
+    def getBuckets(self, hours=None, days=None):
+        """
+        Method that gets the positions of the records in the hours of day and 
+        the days of week (0 - Monday, 6 - Sunday), sorted by bucket
+        """
+        table = self._bucketTable(hours, days)
+        return np.concatenate([self.bucketOrder[self.bucketOffsets[bucket]:self.bucketOffsets[bucket+1]] \
+                               for bucket in np.flatnonzero(table)] + [np.array([], dtype='int64')])
+    
+    def filterPositions(self, positions, hours=None, days=None):
+        """
+        Method that keeps the positions of the records in the hours of day and 
+        the days of week in O(len(positions))
+        """
+        bucket = self.bucket[positions]
+        table = self._bucketTable(hours, days)
+        return positions[(bucket >= 0) & table[np.maximum(bucket, 0)]]
+    
+    
+class KeywordIndex():
+    """
+    Inverted index of the words of the incident texts. A document is a detail 
+    message or the description / location of a record, and belongs to an 
+    incident. The postings keep the position of each word in its document,
+    so phrases are answered without the texts.
+    Words are lower-case runs of letters and digits.
+    
+    Parameters
+    ----------
+    
+    texts:              array-like (str)
+                        text of each document
+                        
+    docIncId:           array-like (int)
+                        incident id of each document
+                        
+    docSource:          array-like (int)
+                        source of each document, an index of SOURCES
+                        
+    Attributes
+    ----------
+    
+    vocabulary:         Pandas.Index
+                        sorted words
+    
+    offsets:            numpy.array(int64)
+                        start of the postings of each word
+                        
+    postings:           numpy.array(int64)
+                        document number << 16 | position of the word, sorted in each word
+    """
+    SOURCES = ['detail', 'description', 'location']
+    TOKEN = r'[a-z0-9]+'
+    
+    def __init__(self, texts=None, docIncId=None, docSource=None):
+        if texts is None: # filled by fromTables
+            return
+        self.docIncId = np.asarray(docIncId, dtype='int64')
+        self.docSource = np.asarray(docSource, dtype='int8')
+        
+        tokens = pd.Series(np.asarray(texts, dtype=object)).fillna('').astype(str).str.lower().str.findall(self.TOKEN)
+        tokens = tokens.explode().dropna()
+        doc = tokens.index.values.astype('int64')
+        # documents longer than 65535 words are truncated
+        position = tokens.groupby(level=0).cumcount().values.astype('int64')
+        keep = position < (1 << 16)
+        
+        codes, vocabulary = pd.factorize(tokens.values[keep], sort=True)
+        keys = (doc[keep] << 16) | position[keep]
+        order = np.lexsort((keys, codes))
+        
+        self.vocabulary = pd.Index(vocabulary)
+        self.postings = keys[order]
+        self.offsets = np.zeros(len(vocabulary) + 1, dtype='int64')
+        np.cumsum(np.bincount(codes, minlength=len(vocabulary)), out=self.offsets[1:])
+        
+    @staticmethod
+    def _text(column):
+        return column.astype(object).where(column.map(lambda val: isinstance(val, str)), '')
+    
+    @classmethod
+    def fromRecords(cls, dataRecord, dataDetail, detailIndex=None):
+        """
+        Method that builds the index from the description (4) and location (5)
+        of the records and the detail messages (3), or from the index of the 
+        detail messages (see fromDetail) when detailIndex is given
+        """
+        if detailIndex is not None:
+            texts = pd.concat([cls._text(dataRecord[4]), cls._text(dataRecord[5])], ignore_index=True)
+            docIncId = np.concatenate([dataRecord.index.values, dataRecord.index.values])
+            docSource = np.repeat([1, 2], len(dataRecord))
+            return cls.merge([detailIndex, cls(texts, docIncId, docSource)])
+        
+        texts = pd.concat([cls._text(dataDetail[3]), cls._text(dataRecord[4]), cls._text(dataRecord[5])], \
+                          ignore_index=True)
+        docIncId = np.concatenate([dataDetail[0].values, dataRecord.index.values, dataRecord.index.values])
+        docSource = np.repeat(np.arange(len(cls.SOURCES)), [len(dataDetail), len(dataRecord), len(dataRecord)])
+        return cls(texts, docIncId, docSource)
+    
+    @classmethod
+    def fromDetail(cls, dataDetail):
+        """
+        Method that builds the index of the detail messages (3) only
+        """
+        return cls(cls._text(dataDetail[3]), dataDetail[0].values, np.zeros(len(dataDetail), dtype='int8'))
+    
+    @classmethod
+    def merge(cls, indexes, keepDocs=None):
+        """
+        Method that merges indexes, the documents of each index follow those of the previous index
+        
+        Parameters
+        ----------
+        
+        indexes:    list
+                    list of KeywordIndex
+                    
+        keepDocs:   numpy.array(bool)
+                    True for the documents to keep among the merged documents, all if None
+                    
+        Return
+        ------
+        merged:     KeywordIndex
+        """
+        vocabulary = pd.Index(np.unique(np.concatenate([index.vocabulary.values.astype(object) \
+                                                        for index in indexes] + [np.array([], dtype=object)])))
+        codes = []
+        keys = []
+        docCount = 0
+        for index in indexes:
+            codes.append(np.repeat(vocabulary.get_indexer(index.vocabulary), np.diff(index.offsets)))
+            keys.append(index.postings + (docCount << 16))
+            docCount += len(index.docIncId)
+        codes = np.concatenate(codes + [np.array([], dtype='int64')])
+        keys = np.concatenate(keys + [np.array([], dtype='int64')])
+        docIncId = np.concatenate([index.docIncId for index in indexes] + [np.array([], dtype='int64')])
+        docSource = np.concatenate([index.docSource for index in indexes] + [np.array([], dtype='int8')])
+        
+        if keepDocs is not None: # the documents are numbered again in their order
+            docs = keys >> 16
+            keep = keepDocs[docs]
+            docNumber = np.cumsum(keepDocs) - 1
+            keys = (docNumber[docs[keep]] << 16) | (keys[keep] & 0xFFFF)
+            codes = codes[keep]
+            docIncId = docIncId[keepDocs]
+            docSource = docSource[keepDocs]
         
-        return [int(mmddyyyy[2]), int(mmddyyyy[0]), int(mmddyyyy[1]), int(hhmmss[0]), int(hhmmss[1]), int(hhmmss[2])]
+        # the words left without postings are dropped
+        used, codes = np.unique(codes, return_inverse=True)
+        order = np.lexsort((keys, codes))
+        
+        merged = cls()
+        merged.vocabulary = vocabulary[used]
+        merged.postings = keys[order]
+        merged.offsets = np.zeros(len(used) + 1, dtype='int64')
+        np.cumsum(np.bincount(codes, minlength=len(used)), out=merged.offsets[1:])
+        merged.docIncId = docIncId.astype('int64')
+        merged.docSource = docSource.astype('int8')
+        return merged
+    
+    def _getPostings(self, word):
+        ind = self.vocabulary.get_indexer([word])[0]
+        if ind == -1:
+            return np.array([], dtype='int64')
+        return self.postings[self.offsets[ind]:self.offsets[ind+1]]
+    
+    def getIds(self, phrase, sources=None):
+        """
+        Method that gets the incidents whose texts include a word or a phrase
+        
+        Parameters
+        ----------
+        
+        phrase:     str
+                    a word or consecutive words, e.g. 'debris' or 'carpool lane'
+                    
+        sources:    list
+                    sources to search among SOURCES, all if None
+                    
+        Return
+        ------
+        ids:        numpy.array(int64)
+                    sorted unique incident ids
+        """
+        words = re.findall(self.TOKEN, phrase.lower())
+        if words == []:
+            return np.array([], dtype='int64')
+        
+        # the i-th word of a phrase is at (the position of the first word + i)
+        keys = self._getPostings(words[0])
+        for ind, word in enumerate(words[1:], 1):
+            keys = np.intersect1d(keys, self._getPostings(word) - ind, assume_unique=True)
+        
+        docs = np.unique(keys >> 16)
+        if sources is not None:
+            sourceCodes = [self.SOURCES.index(source) for source in sources]
+            docs = docs[np.isin(self.docSource[docs], sourceCodes)]
+        return np.unique(self.docIncId[docs])
+    
+    def toTables(self):
+        """
+        Method that converts the index to two pyarrow tables (words, documents) for the cache
+        """
+        postingList = pa.ListArray.from_arrays(pa.array(self.offsets.astype('int32')), pa.array(self.postings))
+        wordTable = pa.table({'word': pa.array(self.vocabulary.values.astype(str)), 'postings': postingList})
+        docTable = pa.table({'incId': pa.array(self.docIncId), 'source': pa.array(self.docSource)})
+        return wordTable, docTable
+    
+    @classmethod
+    def fromTables(cls, wordTable, docTable):
+        """
+        Method that restores the index from the tables of toTables
+        """
+        keywordIndex = cls()
+        postingList = wordTable.column('postings').combine_chunks()
+        keywordIndex.vocabulary = pd.Index(wordTable.column('word').to_pylist(), dtype=object)
+        keywordIndex.offsets = postingList.offsets.to_numpy().astype('int64')
+        keywordIndex.postings = postingList.values.to_numpy().astype('int64')
+        keywordIndex.docIncId = docTable.column('incId').to_numpy().astype('int64')
+        keywordIndex.docSource = docTable.column('source').to_numpy().astype('int8')
+        return keywordIndex
     
     
 class Incidents(Data):
@@ -336,79 +1715,488 @@ class Incidents(Data):
     ----------
     
     Inherited from _Data class
+    
+    yyyymm:             list
+                        (year, month) of the loaded months
+    
+    categoryIndex:      CategoryIndex (read-only)
+                        index of the records by facility type and incident type,
+                        built on first use
+                        
+    timeIndex:          TimeIndex (read-only)
+                        index of the records by time, built on first use
     """    
+    # column type of colRecordDict: pandas dtype of the exported column
+    EXPORT_TYPES = {'int': 'Int64', 'float': 'float64', 'str': object, 'boolean': 'bool', 'set': object}
+    # arrow types of the exported columns, by the type aliases of pyarrow
+    EXPORT_ARROW_TYPES = {'int': 'int64', 'float': 'float64', 'str': 'string', 'boolean': 'bool', 'set': 'string'}
     
-    def __init__(self, year, month):
-        Data.__init__(self, year, month)
+    def __init__(self, year, month, cache=False, chunkSize=None, fields=None, keepMessages=False):
+        self._categoryIndex = None
+        self._timeIndex = None
+        Data.__init__(self, year, month, cache, chunkSize, fields, keepMessages)
+        self.yyyymm = [(year, month)]
+
+    def classify(self, ruleSet=None, names=None):
+        Data.classify(self, ruleSet, names)
+        self._categoryIndex = None # the flags of the index may have changed
+
+    @property
+    def categoryIndex(self):
+        return self._getCategoryIndex('HOV')
     
-    def getRecords(self, incType='All', facilType='All'):
+    def _getCategoryIndex(self, facilType='All'):
+        # 21 - hov / 22 - accident / 23 - hazard => 12 combinations
+        # hov, which needs the detail file, is required only for the facility types
+        if facilType.lower() == 'all':
+            self.require('type')
+        else:
+            self.require('type', 'hov')
         
-        incTypeList = ['accident', 'hazard', 'others', 'all']
-        facilTypeList = ['hov', 'ml', 'all']
+        hasHov = 'hov' in self.derivedFields
+        if self._categoryIndex is None or (hasHov and not self._categoryIndex.hasHov):
+            self._categoryIndex = CategoryIndex(self.dataRecord[21].values if hasHov else None, \
+                                                self.dataRecord[22].values, self.dataRecord[23].values)
+        return self._categoryIndex
+    
+    @property
+    def timeIndex(self):
+        if self._timeIndex is None:
+            self.require('time')
+            self._timeIndex = TimeIndex(*[self.dataRecord[col].values for col in [28, 24, 25, 26, 27]])
+        return self._timeIndex
+    
+    @classmethod
+    def combine(cls, incidentsList):
+        """
+        Method that combines the incidents of several months into one queryable
+        incidents object. year and month of the output are None.
+        Detail ids are matched again over the combined dataset.
         
-        assert(incType.lower() in incTypeList and facilType.lower() in facilTypeList)
+        Parameters
+        ----------
         
-        # 21 - hov / 22 - accident / 23 - hazard => 12 combinations
-        if facilType.lower() == 'all' and incType.lower() == 'all':
-            return self.dataRecordDict
-        elif facilType.lower() == 'all' and incType.lower() == 'accident':
-            return {key:val for key, val in self.dataRecordDict.items() if val[22] == True}
-        elif facilType.lower() == 'all' and incType.lower() == 'hazard':
-            return {key:val for key, val in self.dataRecordDict.items() if val[23] == True}
-        elif facilType.lower() == 'all' and incType.lower() == 'others':
-            return {key:val for key, val in self.dataRecordDict.items() if val[22] == False and val[23] == False}
-        
-        elif facilType.lower() == 'hov' and incType.lower() == 'all':
-            return {key:val for key, val in self.dataRecordDict.items() if val[21] == True}
-        elif facilType.lower() == 'hov' and incType.lower() == 'accident':
-            return {key:val for key, val in self.dataRecordDict.items() if val[21] == True and val[22] == True}
-        elif facilType.lower() == 'hov' and incType.lower() == 'hazard':
-            return {key:val for key, val in self.dataRecordDict.items() if val[21] == True and val[23] == True}
-        elif facilType.lower() == 'hov' and incType.lower() == 'others':
-            return {key:val for key, val in self.dataRecordDict.items() if val[21] == True and val[22] == False and val[23] == False}
-        
-        elif facilType.lower() == 'ml' and incType.lower() == 'all':
-            return {key:val for key, val in self.dataRecordDict.items() if val[21] == False}
-        elif facilType.lower() == 'ml' and incType.lower() == 'accident':
-            return {key:val for key, val in self.dataRecordDict.items() if val[21] == False and val[22] == True}
-        elif facilType.lower() == 'ml' and incType.lower() == 'hazard':
-            return {key:val for key, val in self.dataRecordDict.items() if val[21] == False and val[23] == True}
-        elif facilType.lower() == 'ml' and incType.lower() == 'others':
-            return {key:val for key, val in self.dataRecordDict.items() if val[21] == False and val[22] == False and val[23] == False}
+        incidentsList:  list
+                        list of Incidents
+                        
+        Return
+        ------
+        combined:       Incidents
+        """
+        combined = cls.__new__(cls)
+        combined.year = None
+        combined.month = None
+        combined.chunkSize = None
+        combined.keepMessages = all(inc.keepMessages for inc in incidentsList)
+        combined.yyyymm = [yyyymm for inc in incidentsList for yyyymm in inc.yyyymm]
+        combined._categoryIndex = None
+        combined._timeIndex = None
+        
+        # the fields derived in any month are derived in every month
+        fields = set.union(*[inc.derivedFields for inc in incidentsList])
+        for inc in incidentsList:
+            inc.require(*sorted(fields))
+        combined.derivedFields = fields
+        
+        first = incidentsList[0]
+        combined.colNameFileRecord = first.colNameFileRecord
+        combined.colNameFileDetail = first.colNameFileDetail
+        combined.colRecordDict = dict(first.colRecordDict)
+        combined.colDetailDict = dict(first.colDetailDict)
+        combined.ruleSet = first.ruleSet
+        
+        # the last month wins when an incident id is duplicated
+        dataRecord = concatCategories([inc.dataRecord for inc in incidentsList])
+        combined.dataRecord = dataRecord[~dataRecord.index.duplicated(keep='last')]
         
+        combined._dataDetail = None
+        combined._detailHits = None
+        combined._detailKeywordIndex = None
+        combined._keywordIndex = None
+        if all(inc._dataDetail is not None for inc in incidentsList):
+            combined.dataDetail = pd.concat([inc.dataDetail for inc in incidentsList])
+            if not combined.keepMessages: # the hits of the months are combined, the messages are dropped
+                combined.dataDetail = combined.dataDetail.drop(columns=3, errors='ignore')
+                hitsList = [inc._getDetailHits() for inc in incidentsList]
+                combined._detailHits = {condition: np.unique(np.concatenate([hits[condition] for hits in hitsList])) \
+                                        for condition in first.ruleSet.getDetailConditions()}
+        if 'detail_id' in fields:
+            combined.detailOffsets, combined.detailIds = matchDetailId(combined.dataRecord.index.values, \
+                                                                       combined.dataDetail[0].values, \
+                                                                       combined.dataDetail.index.values)
+        return combined
+    
+    def countRecords(self, incType='All', facilType='All'):
+        """
+        Method that gets the number of records of a combination of incident type 
+        and facility type
+        """
+        return self._getCategoryIndex(facilType).count(incType, facilType)
+    
+    def getRecordIds(self, incType='All', facilType='All'):
+        """
+        Method that gets the incident ids of a combination of incident type and 
+        facility type in numpy array
+        """
+        return self.dataRecord.index.values[self._getCategoryIndex(facilType).getPositions(incType, facilType)]
+    
+    def getRecordFrame(self, incType='All', facilType='All'):
+        """
+        Method that gets the records of a combination of incident type and 
+        facility type as a dataframe (index - incident_id).
+        It includes the derived fields computed so far.
+        """
+        if incType.lower() == 'all' and facilType.lower() == 'all':
+            return self.dataRecord
+        return self.dataRecord.iloc[self._getCategoryIndex(facilType).getPositions(incType, facilType)]
+    
+    def _getTimePositions(self, incType, facilType, start, end, hours, days):
+        # the narrowest lookup comes first, the others filter its output
+        if start is not None or end is not None:
+            positions = self.timeIndex.getRange(start, end)
+            if hours is not None or days is not None:
+                positions = self.timeIndex.filterPositions(positions, hours, days)
+        else:
+            positions = self.timeIndex.getBuckets(hours, days)
+        
+        if incType.lower() != 'all' or facilType.lower() != 'all':
+            positions = self._getCategoryIndex(facilType).filterPositions(positions, incType, facilType)
+        return positions
+    
+    def getRecordIdsByTime(self, incType='All', facilType='All', start=None, end=None, hours=None, days=None):
+        """
+        Method that gets the incident ids of a combination of incident type and 
+        facility type in a time window, in numpy array
+        
+        Parameters
+        ----------
+        
+        incType:        str
+                        'Accident', 'Hazard', 'Others' or 'All'
+                        
+        facilType:      str
+                        'HOV', 'ML' or 'All'
+                        
+        start:          int or str
+                        unix time or timestamp (MM/DD/YYYY HH24:MI:SS), inclusive
+                        
+        end:            int or str
+                        unix time or timestamp (MM/DD/YYYY HH24:MI:SS), exclusive
+                        
+        hours:          list
+                        hours of day, e.g. range(6, 9) for 6 - 9 AM
+                        
+        days:           list
+                        days of week, 0 - Monday ... 6 - Sunday, e.g. range(5) for weekdays
+        
+        Return
+        ------
+        ids:            numpy.array
+                        incident ids, sorted by time when start or end is given
+        """
+        positions = self._getTimePositions(incType, facilType, start, end, hours, days)
+        return self.dataRecord.index.values[positions]
+    
+    def getRecordFrameByTime(self, incType='All', facilType='All', start=None, end=None, hours=None, days=None):
+        """
+        Method that gets the records of getRecordIdsByTime as a dataframe
+        """
+        return self.dataRecord.iloc[self._getTimePositions(incType, facilType, start, end, hours, days)]
+    
+    def getRecords(self, incType='All', facilType='All'):
+        """
+        Method that gets the records of a combination of incident type and 
+        facility type in dictionary type
+        """
+        self.require(*self.DERIVED_FIELDS)
+        return self._toNestedDict(self.getRecordFrame(incType, facilType))
+        
+    def getExportFrame(self, incType='All', facilType='All'):
+        """
+        Method that gets the records of a combination of incident type and 
+        facility type as a typed dataframe for export (see exportIncidents).
+        The columns are named by colRecordDict, the incident id comes first, 
+        text missing values (-1) are null and the detail ids are joined by spaces.
+        """
+        self.require(*self.DERIVED_FIELDS)
+        frame = self.getRecordFrame(incType, facilType)
+        pos = self.dataRecord.index.get_indexer(frame.index)
+        
+        columns = {self.colRecordDict[0][0] if 0 in self.colRecordDict else 'IncId': frame.index.values}
+        for col, (name, ty) in self.colRecordDict.items():
+            if col == 0:
+                continue
+            if col == 20: # detail_id
+                values = [' '.join(map(str, self.detailIds[self.detailOffsets[p]:self.detailOffsets[p+1]])) \
+                          if self.detailOffsets[p] != self.detailOffsets[p+1] else None for p in pos]
+            elif ty in ('str', 'set'):
+                values = frame[col].astype(object)
+                values = values.where(values.map(lambda val: isinstance(val, str)), None).values
+            else:
+                values = frame[col].values
+            columns[name] = pd.Series(values, dtype=self.EXPORT_TYPES[ty])
+        return pd.DataFrame(columns)
+    
+    def getExportSchema(self):
+        """
+        Method that gets the arrow schema of getExportFrame from colRecordDict, 
+        which does not depend on the values of any month (e.g. a column with no value)
+        """
+        self.require(*self.DERIVED_FIELDS)
+        fields = [(self.colRecordDict[0][0] if 0 in self.colRecordDict else 'IncId', pa.int64())]
+        for col, (name, ty) in self.colRecordDict.items():
+            if col != 0:
+                fields.append((name, pa.type_for_alias(self.EXPORT_ARROW_TYPES[ty])))
+        return pa.schema(fields)
+    
     def getHovAccident(self):
         """
         Method that gets hov accidents in dictionary type
         """
-        return {key:val for key, val in self.dataRecordDict.items() if val[21] == True and val[22] == True}
+        return self.getRecords('Accident', 'HOV')
     
     def getHovHazard(self):
         """
         Method that gets hov hazards in dictionary type
         """
-        return {key:val for key, val in self.dataRecordDict.items() if val[21] == True and val[23] == True}
+        return self.getRecords('Hazard', 'HOV')
     
     def getHovEtc(self):
         """
         Method that gets hov incidents except for accidents and hazards in dictionary type
         """
-        return {key:val for key, val in self.dataRecordDict.items() if val[21] == True and val[22] == False and val[23] == False}
+        return self.getRecords('Others', 'HOV')
     
     
     
+class SourceManifest():
+    """
+    Fingerprints of the raw files of the months processed by the pipeline, 
+    kept in a json file so that a refresh processes only the months whose 
+    files are new or changed.
+    
+    Parameters
+    ----------
+    
+    path:               str
+                        path of the manifest file, C.MANIFEST if None
+    inputs:             dictionary
+                        {name: path} of the files every month depends on besides its raw files
+                        (e.g. the highway network), a change of which invalidates every month
+                        
+    Attributes
+    ----------
+    
+    months:             dictionary
+                        {'yyyy_mm': {'record', 'detail', 'colName', *inputs: fingerprint}}
+    """
+    def __init__(self, path=None, inputs=None):
+        self.path = C.MANIFEST if path is None else path
+        self.inputs = {} if inputs is None else dict(inputs)
+        assert(not set(self.inputs) & {'record', 'detail', 'colName'}), 'input names must differ from the raw file keys'
+        self.months = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.months = json.load(f)
+    
+    @staticmethod
+    def _key(year, month):
+        return '{}_{:02}'.format(year, month)
+    
+    def _getPaths(self, year, month):
+        # the raw files of the month and the common inputs
+        paths = Data.getSourcePaths(year, month)
+        paths.update(self.inputs)
+        return paths
+    
+    def isChanged(self, year, month):
+        """
+        Method that checks if the files of a month are new or changed since the month was processed.
+        The refreshed fingerprints of the unchanged files are kept until save.
+        """
+        cached = self.months.get(self._key(year, month), {})
+        return any(isFileChanged(path, cached.get(key)) for key, path in self._getPaths(year, month).items())
+    
+    def getChanged(self, yyyymmList):
+        """
+        Method that gets the months to process among the published months
+        
+        Parameters
+        ----------
+        
+        yyyymmList:     list
+                        [(year, month)]
+                        
+        Return
+        ------
+        changed:        list
+                        sorted [(year, month)] whose record file exists and is new or changed
+        """
+        return [(year, month) for year, month in sorted(yyyymmList) \
+                if os.path.exists(Data.getSourcePaths(year, month)['record']) and self.isChanged(year, month)]
+    
+    def update(self, year, month):
+        """
+        Method that records the current files of a processed month, call save to write the manifest
+        """
+        self.months[self._key(year, month)] = {key: fileFingerprint(path) \
+                                               for key, path in self._getPaths(year, month).items()}
+        
+    def save(self):
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(self.months, f, indent=1, sort_keys=True)
+        os.replace(self.path + '.tmp', self.path)
+        
+        
+def _loadMonth(args):
+    year, month, kwargs = args
+    try:
+        inc = Incidents(year, month, **kwargs)
+    except Exception as e:
+        return (year, month), None, '{}: {}'.format(type(e).__name__, e)
+    return (year, month), inc, None
+
+
+def loadIncidents(yyyymmList, processes=None, cache=False, chunkSize=None, fields=None, keepMessages=False):
+    """
+    Method that loads a range of months across a process pool and combines
+    them into one Incidents. A month that fails to load is reported and 
+    skipped without aborting the others.
+    On Windows, call it under if __name__ == "__main__":
+    
+    Parameters
+    ----------
+    
+    yyyymmList     : list
+                     list of tuple(year, month)
+                     
+    processes      : int
+                     number of worker processes, os.cpu_count() if None \n
+                     1 - loads the months in the current process
+                     
+    cache          : boolean
+                     passed to Incidents
+                     
+    chunkSize      : int
+                     passed to Incidents
+                     
+    fields         : list
+                     passed to Incidents
+                     
+    keepMessages   : boolean
+                     passed to Incidents
+                     
+    Return
+    ------
+    incidents      : Incidents
+                     combined incidents of the loaded months, None if nothing is loaded
+                     
+    failures       : dictionary
+                     {(year, month): error message}
+    """
+    kwargs = {'cache': cache, 'chunkSize': chunkSize, 'fields': fields, 'keepMessages': keepMessages}
+    argsList = [(year, month, kwargs) for year, month in yyyymmList]
+    if processes is None:
+        processes = min(len(argsList), os.cpu_count() or 1)
+    
+    if processes <= 1:
+        results = [_loadMonth(args) for args in argsList]
+    else:
+        with multiprocessing.Pool(processes) as pool:
+            results = pool.map(_loadMonth, argsList, chunksize=1)
+    
+    loaded = [inc for _, inc, _ in results if inc is not None]
+    failures = {yyyymm: error for yyyymm, _, error in results if error is not None}
+    for yyyymm, error in failures.items():
+        print('{}-{:02} is not loaded. {}'.format(yyyymm[0], yyyymm[1], error))
+    
+    if loaded == []:
+        return None, failures
+    return Incidents.combine(loaded), failures
+    
+    
+def exportIncidents(yyyymmList, path, incType='All', facilType='All', cache=False, chunkSize=None):
+    """
+    Method that exports the records of a combination of incident type and 
+    facility type month by month to a csv or parquet file. Only one month is 
+    held in memory at a time, and every month is written with the same typed
+    columns (Incidents.getExportFrame). A month that fails to load is 
+    reported and skipped.
+    
+    Parameters
+    ----------
+    
+    yyyymmList     : list
+                     list of tuple(year, month)
+                     
+    path           : str
+                     path of the output, .csv or .parquet
+                     
+    incType        : str
+                     'Accident', 'Hazard', 'Others' or 'All'
+                     
+    facilType      : str
+                     'HOV', 'ML' or 'All'
+                     
+    cache          : boolean
+                     passed to Incidents
+                     
+    chunkSize      : int
+                     passed to Incidents
+                     
+    Return
+    ------
+    counts         : dictionary
+                     {(year, month): number of exported records}
+    """
+    fileFormat = os.path.splitext(path)[1].lower()
+    assert(fileFormat in ['.csv', '.parquet'])
+    assert(fileFormat == '.csv' or pa is not None), 'pyarrow is required to write parquet files'
+    
+    counts = {}
+    writer = None # parquet writer or the header flag of csv
+    # the output replaces the file at the end, so an interrupted export leaves the old file
+    try:
+        for year, month in yyyymmList:
+            try:
+                inc = Incidents(year, month, cache=cache, chunkSize=chunkSize)
+            except Exception as e:
+                print('{}-{:02} is not exported. {}: {}'.format(year, month, type(e).__name__, e))
+                continue
+            frame = inc.getExportFrame(incType, facilType)
+            
+            if fileFormat == '.csv':
+                frame.to_csv(path + '.tmp', index=False, mode='w' if writer is None else 'a', header=writer is None)
+                writer = True
+            else:
+                # the schema is built once from the columns, not from the values of the first month
+                if writer is None:
+                    schema = inc.getExportSchema()
+                    writer = pq.ParquetWriter(path + '.tmp', schema)
+                writer.write_table(pa.Table.from_pandas(frame, schema=schema, preserve_index=False))
+            del inc
+            counts[(year, month)] = len(frame)
+            del frame
+    except:
+        if fileFormat == '.parquet' and writer is not None:
+            writer.close()
+        if os.path.exists(path + '.tmp'):
+            os.remove(path + '.tmp')
+        raise
+    if fileFormat == '.parquet' and writer is not None:
+        writer.close()
+        
+    if writer is not None:
+        os.replace(path + '.tmp', path)
+    return counts
+    
+    
 if __name__== "__main__":
     pass
     year = 2017
     month = 12
     
-    accident_all_dict = {}
-    for month in range(1,13):
-        test = Incidents(year, month)
-        accident_all = test.getRecords('Accident', 'All')
-        accident_all_dict.update(accident_all)
-        
-    acci_all_df = pd.DataFrame(accident_all_dict).transpose()
     acci_all_df_path = '{}Accidents_{}.csv'.format(C.ROOT, year)
-    acci_all_df.to_csv(acci_all_df_path)
+    exportIncidents([(year, month) for month in range(1,13)], acci_all_df_path, 'Accident', 'All')
     
     
@@ -5,6 +5,7 @@ sys.path.append(C.ROOT)
 sys.path.append(C.BPSPATIAL)
 
 import pickle
+import os
 
 import FileIO.SHP as SIO
 import FileIO.Graph as GIO
@@ -35,14 +36,39 @@ month = set([mon for mon in range(1,13)])
 yyyymm = set([(yr, mon) for yr in year
                         for mon in month])
 
+# Incremental mode: only the months whose raw files are new or changed since 
+# the last run (or whose monthly output is missing) are processed, 
+# and the yearly excel files of those months are merged from the monthly outputs
+INCREMENTAL = True
+# the highway network is an input of every month, so a new network invalidates every month
+hwyHOVSplitPath = '{}_03_2_CA_HOV_All_split_by_station_arcmap.shp'.format(C.HIGHWAYS)
+hwySplitOrderedDictPath = '{}hwySplitOrderedDict.p'.format(C.HIGHWAYS)
+manifest = Incidents.SourceManifest(inputs={'hwySplitShp': hwyHOVSplitPath,
+                                            'hwySplitDbf': hwyHOVSplitPath[:-4] + '.dbf',
+                                            'hwySplitOrderedDict': hwySplitOrderedDictPath})
+
+def monthlyOutputPath(yr, mon):
+    return '{}HOV_Accidents_{}_{:02}.p'.format(C.INCIDENTS, yr, mon)
+
+if INCREMENTAL:
+    yyyymmTodo = set(manifest.getChanged(yyyymm))
+    manifest.save() # keeps the refreshed fingerprints of the unchanged files
+    yyyymmTodo.update([(yr, mon) for yr, mon in yyyymm if not os.path.exists(monthlyOutputPath(yr, mon)) \
+                       and os.path.exists(Incidents.Data.getSourcePaths(yr, mon)['record'])])
+else:
+    yyyymmTodo = yyyymm
+print('months to process:', sorted(yyyymmTodo))
+
 for yr in sorted(year):
-    hovAccDict={}    
-    for mon in sorted(month):
+    monthTodo = sorted([mon for (yrTodo, mon) in yyyymmTodo if yrTodo == yr])
+    if monthTodo == []: # the yearly output is up to date
+        continue
+    
+    for mon in monthTodo:
         print(yr, mon)
         ## Paths
         hovAccPath = '{}HOV_Accidents_{}_{:02}.shp'.format(C.INCIDENTS, yr, mon)
         hovAccPrjPath = '{}HOV_Accidents_{}_{:02}_prj.shp'.format(C.INCIDENTS, yr, mon)
-        hwyHOVSplitPath = '{}_03_2_CA_HOV_All_split_by_station_arcmap.shp'.format(C.HIGHWAYS)
         
         ## Projection
         crsPrj = SIO.Projection.getPROJ4(C.CRS_PRJ[0], C.CRS_PRJ[1])
@@ -91,7 +117,10 @@ for yr in sorted(year):
         # =============================================================================
         
         # spatial joint
-        AG.spatialjoin.nearest(hovAccGraph, hwyHOVSplitGraph, criterion='Direction', threshold = 30)
+        # the segment indexes of each direction are saved next to the hwy split file and reused
+        hwyHOVSplitIndexPath = '{}_03_2_CA_HOV_All_split_by_station_sjidx'.format(C.HIGHWAYS)
+        AG.spatialjoin.nearest(hovAccGraph, hwyHOVSplitGraph, criterion='Direction', threshold = 30, \
+                               indexPath=hwyHOVSplitIndexPath)
         
         # =============================================================================
         # 3. Join attributes of Accidents and hwy segments defined in Highway.py
@@ -104,7 +133,7 @@ for yr in sorted(year):
         # =============================================================================
         
         # Open ordered hwy split segments dictionary in pickle
-        hwySplitOrderedDictPickle = pickle.load(open('{}hwySplitOrderedDict.p'.format(C.HIGHWAYS), 'rb'))
+        hwySplitOrderedDictPickle = pickle.load(open(hwySplitOrderedDictPath, 'rb'))
         
         # define a new dictionary for efficient join
         hwySplitOrderedDict = {} # {edgeInd: [(edge[0], edge[1], edge[2])]}
@@ -166,8 +195,32 @@ for yr in sorted(year):
                 hovAccCopy[point[1]['IncId']][hovAccKeys[3]] = point[1]['station2_ID']
             except:
                 pass
-            
-        hovAccDict.update(hovAccCopy)
+        
+        # the monthly output is kept for the yearly merge, and the month is recorded as processed
+        pickle.dump((hovAccCopy, hovAccColNames), open(monthlyOutputPath(yr, mon), 'wb'))
+        manifest.update(yr, mon)
+        manifest.save()
+    
+    # =============================================================================
+    # 5. Merge the monthly outputs of the year
+    #   Input: 
+    #       1) HOV_Accidents_yyyy_mm.p - monthly HOV accidents with near stations
+    #   Output: 
+    #       1) HOV_Accidents_yyyy.xlsx
+    # =============================================================================
+    monthDone = [mon for mon in sorted(month) if os.path.exists(monthlyOutputPath(yr, mon))]
+    
+    # an incident id in several months is written once, with the values of the last month
+    lastMonthDict = {} # {incId: month}
+    for mon in monthDone:
+        hovAccMonth, hovAccColNames = pickle.load(open(monthlyOutputPath(yr, mon), 'rb'))
+        lastMonthDict.update(dict.fromkeys(hovAccMonth, mon))
+        
+    # the rows are streamed month by month, so only one month is held in memory
+    def hovAccMonths():
+        for mon in monthDone:
+            hovAccMonth, _ = pickle.load(open(monthlyOutputPath(yr, mon), 'rb'))
+            yield {incId: val for incId, val in hovAccMonth.items() if lastMonthDict[incId] == mon}
     
     hovAccStationsExcelPath = '{}HOV_Accidents_{}.xlsx'.format(C.INCIDENTS, yr)
-    EIO.nestedDict_to_xlsx(hovAccDict, hovAccStationsExcelPath, 'Sheet1', hovAccColNames)
+    EIO.nestedDicts_to_xlsx(hovAccMonths(), hovAccStationsExcelPath, 'Sheet1', hovAccColNames)
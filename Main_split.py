@@ -17,6 +17,7 @@ shpHOVPath = '{}CA_HOV_Access_prj.shp'.format(IC.HIGHWAYS)
 intersectGraphPath = '{}CA_HOV_intersect.shp'.format(IC.HIGHWAYS)
 splitByDistGraphPath = '{}CA_HOV_split_500m.shp'.format(IC.HIGHWAYS)
 splitSjGraphPath = '{}CA_HOV_split_500m_line.shp'.format(IC.HIGHWAYS)
+splitSjIndexPath = '{}CA_HOV_split_500m_line_sjidx'.format(IC.HIGHWAYS) # segment indexes of each direction
 
 
 # projection
@@ -77,7 +78,7 @@ for year in range(2014, 2018+1):
     hovAccPrjGraph = GIO.Point.fromShapefile(shpHOVAccPrjPath, 'Route Direction'.split(sep=' '))
     # Spatial join
     splitSjGraphCopy = copy.deepcopy(splitSjGraph)
-    AG.spatialjoin.joincount(hovAccPrjGraph, splitSjGraphCopy, criterion='Direction', threshold=20)
+    AG.spatialjoin.joincount(hovAccPrjGraph, splitSjGraphCopy, criterion='Direction', threshold=20, indexPath=splitSjIndexPath)
     splitJoincountPath = '{}CA_HOV_split_500m_line_sj_{}.shp'.format(IC.HIGHWAYS, year)
     SIO.Polyline.fromGraph(splitSjGraphCopy, splitJoincountPath)
     SIO.Projection.copyCRS(projFromPath, splitJoincountPath)
@@ -0,0 +1,60 @@
+import sys
+import CA_HOV_Accidents.Constants as C
+sys.path.append(C.HOME)
+sys.path.append(C.ROOT)
+
+import time
+import datetime
+
+import pandas as pd
+
+import Incidents as Incidents
+
+# =============================================================================
+# Comparison of splitTimeArray with getUnixTime, timestamp by timestamp.
+# Both depend on the local time zone of the machine (time.timezone),
+# so run it under several time zones, e.g.
+#   TZ=UTC python time_test.py
+#   TZ=America/Los_Angeles python time_test.py
+#   TZ=Asia/Kolkata python time_test.py
+# =============================================================================
+validTimestamps = ['01/01/2014 00:00:00', '12/31/2014 23:59:59', '07/04/2015 12:30:15', \
+                   '02/29/2016 08:00:00', # leap day
+                   # DST starts at 2014-03-09 02:00, 02:00 - 02:59:59 do not exist
+                   '03/09/2014 01:59:59', '03/09/2014 02:00:00', '03/09/2014 02:30:00', \
+                   '03/09/2014 02:59:59', '03/09/2014 03:00:00', \
+                   # DST ends at 2014-11-02 02:00, 01:00 - 01:59:59 occur twice
+                   '11/02/2014 00:59:59', '11/02/2014 01:00:00', '11/02/2014 01:30:00', \
+                   '11/02/2014 01:59:59', '11/02/2014 02:00:00', \
+                   '03/08/2015 02:15:00', '11/01/2015 01:15:00']
+
+invalidTimestamps = ['', 'nan', None, -1, float('nan'), '13/01/2014 00:00:00', '02/30/2014 00:00:00', \
+                     '11/02/2014 24:00:00', '2014-11-02 01:00:00', '11/02/2014', '11/02/2014 01:00']
+
+def getExpected(timestamp):
+    # year, month, day, hour and unix time of a timestamp by getUnixTime
+    dt = datetime.datetime.strptime(timestamp, '%m/%d/%Y %H:%M:%S')
+    timeList = [dt.year, dt.month, dt.day, dt.hour, dt.minute, dt.second]
+    return {'year': dt.year, 'month': dt.month, 'day': dt.day, 'hour': dt.hour, \
+            'unixTime': Incidents.getUnixTime(timeList)}
+
+def checkTimestamps(timestamps):
+    timeDict = Incidents.splitTimeArray(timestamps)
+    for ind, timestamp in enumerate(validTimestamps + invalidTimestamps):
+        if ind < len(validTimestamps):
+            expected = getExpected(timestamp)
+        else: # invalid timestamps are marked as -1
+            expected = {key: -1 for key in timeDict}
+        for key, val in expected.items():
+            assert(timeDict[key][ind] == val), (timestamp, key, timeDict[key][ind], val)
+
+if __name__ == "__main__":
+    print('time zone: {} ({} seconds west of UTC)'.format(time.tzname, time.timezone))
+
+    timestamps = validTimestamps + invalidTimestamps
+    checkTimestamps(timestamps)
+    print('list - OK')
+    # column 3 of the records can be read as categoricals
+    checkTimestamps(pd.Series([str(timestamp) if timestamp is not None else None for timestamp in timestamps], \
+                              dtype='category'))
+    print('categorical - OK')